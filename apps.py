@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class DutilsConfig(AppConfig):
+    name = 'dutils'
+
+    def ready(self):
+        from .modelcache import connect_dependencies
+        connect_dependencies()
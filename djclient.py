@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+'''Run a manage.py command through a warm djworker (manage.py djworker)
+
+    cd <dir with manage.py>
+    python dutils/djclient.py [--start] -- migrate -v 0
+
+Output is streamed back and the exit status is the command's. When no
+worker is listening, the command is run with a plain `python manage.py`
+instead, and with --start a worker is started in the background for
+the next call. Does not import django, so it starts in milliseconds.
+stdin is not forwarded: use plain manage.py for interactive commands.
+'''
+import argparse
+import hashlib
+import json
+import os
+from os.path import abspath, basename, dirname, expanduser, join
+import re
+import socket
+import subprocess
+import sys
+
+SOCKET_DIR = '~/.cache/dutils'
+ACK = b'\0ACK\n'                # sent before the worker runs anything
+TRAILER_RE = re.compile(rb'\0EXIT (-?\d+)\n$')
+TRAILER_MAX = 32              # bytes held back while looking for the trailer
+
+
+def socket_path(projdir):
+    '''Default socket for the project whose manage.py is in projdir'''
+    projdir = abspath(projdir)
+    return expanduser(join(SOCKET_DIR, 'djworker-{}-{}.sock'.format(
+        basename(projdir), hashlib.sha1(projdir.encode()).hexdigest()[:8])))
+
+
+def request(path, message, out):
+    '''Send message to the worker, copy its output to out
+
+    Returns the exit status, or None if no worker took the request (so
+    it is safe to run the command some other way). The worker sends ACK
+    before running anything: once that has arrived, the command may
+    have run, and is never run again here.
+    '''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        conn.sendall(json.dumps(message).encode('utf8') + b'\n')
+    except OSError:
+        conn.close()
+        return None
+    held = b''
+    with conn:
+        while len(held) < len(ACK):
+            data = conn.recv(len(ACK) - len(held))
+            if not data:
+                return None       # worker went away (e.g. reloading)
+            held += data
+        if held != ACK:
+            sys.stderr.write('djclient: unexpected reply from the worker\n')
+            return 1
+        held = b''
+        while True:
+            data = conn.recv(1 << 16)
+            if not data:
+                break
+            held += data
+            out.write(held[:-TRAILER_MAX])
+            out.flush()
+            held = held[-TRAILER_MAX:]
+    match = TRAILER_RE.search(held)
+    if match:
+        out.write(held[:match.start()])
+        out.flush()
+        return int(match.group(1))
+    out.write(held)
+    out.flush()
+    sys.stderr.write('djclient: lost the worker in mid-command\n')
+    return 1
+
+
+def start_worker(path):
+    os.makedirs(dirname(path), exist_ok=True)
+    log = open(path[:-len('.sock')] + '.log', 'ab')
+    subprocess.Popen([sys.executable, 'manage.py', 'djworker',
+                      '--socket', path],
+                     stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                     start_new_session=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run manage.py commands through a warm djworker')
+    parser.add_argument('--socket', help='default: from the current dir')
+    parser.add_argument('--start', action='store_true',
+                        help='start a worker if none is running')
+    parser.add_argument('--stop', action='store_true',
+                        help='stop the worker')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    path = args.socket or socket_path(os.getcwd())
+    command = args.command[1:] if args.command[:1] == ['--'] \
+        else args.command
+
+    if args.stop:
+        code = request(path, dict(stop=True), sys.stdout.buffer)
+        sys.exit(1 if code is None else code)
+    if not command:
+        parser.error('no command given')
+    code = request(path, dict(argv=command), sys.stdout.buffer)
+    if code is None:
+        if args.start:
+            start_worker(path)
+        os.execv(sys.executable, [sys.executable, 'manage.py'] + command)
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
@@ -30,10 +30,13 @@ def backup_filename(c, prefix, ext):
 
 @task
 def managepy(c, command):
+    '''Through a warm djworker (see djclient.py) if c.djworker is set'''
     autoconfig(c)
+    script = 'dutils/djclient.py --start --' \
+        if getattr(c, 'djworker', False) else 'manage.py'
     with c.cd(c.managepydir):
-        result = c.run("{python} manage.py {command}".format(
-            python=c.python, command=command), echo=True)
+        result = c.run("{python} {script} {command}".format(
+            python=c.python, script=script, command=command), echo=True)
         return result.stdout
 
 
@@ -0,0 +1,336 @@
+'''Helpers shared by dumpdb, replacedb and the tasks that move dumps around
+
+Nothing in here imports django, so replacedb.py (which runs before
+django is set up) can use it as well.
+'''
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+from os.path import dirname, basename
+import re
+import tarfile
+import tempfile
+import time
+import zlib
+
+BLOCKSIZE = 1 << 20           # relay / read size
+GZIP_BLOCKSIZE = 4 << 20      # size of one independently compressed member
+
+# Members of a sharded (one file per table) dump. See dumpdb --sharded
+MANIFEST = 'manifest.json'
+SCHEMA_MEMBER = 'schema.sql.gz'
+POST_MEMBER = 'post.sql.gz'       # deferred indexes and constraints
+
+
+def cpu_count():
+    return os.cpu_count() or 1
+
+
+def human_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1024:
+            return '{:.1f}{}'.format(n, unit)
+        n /= 1024
+    return '{:.1f}TB'.format(n)
+
+
+@contextmanager
+def atomic_output(path, mode='wb'):
+    '''Write to a temp file next to path, rename it into place on success
+
+    On failure the temp file is removed and path is left untouched.
+    '''
+    fd, tmppath = tempfile.mkstemp(dir=dirname(path) or '.',
+                                   prefix='.' + basename(path) + '.')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmppath, path)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def _gzip_block(block, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+class ParallelGzipWriter(object):
+    '''File-like object that gzips what is written to it on a thread pool
+
+    Input is cut into blocks and each block becomes an independent gzip
+    member. Members are written out in order, so the result is a normal
+    multi-member .gz file that gunzip reads as a single stream.
+    zlib releases the GIL while compressing, so the threads really
+    do run in parallel.
+    '''
+    def __init__(self, fileobj, threads=None, level=6,
+                 blocksize=GZIP_BLOCKSIZE):
+        self.fileobj = fileobj
+        self.threads = threads or cpu_count()
+        self.level = level
+        self.blocksize = blocksize
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.buf = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def write(self, data):
+        self.buf += data
+        self.bytes_in += len(data)
+        while len(self.buf) >= self.blocksize:
+            self._submit(bytes(self.buf[:self.blocksize]))
+            del self.buf[:self.blocksize]
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(_gzip_block, block, self.level))
+        # bound memory: never keep more than 2 blocks per thread in flight
+        while len(self.pending) > 2 * self.threads:
+            self._write_one()
+
+    def _write_one(self):
+        data = self.pending.popleft().result()
+        self.fileobj.write(data)
+        self.bytes_out += len(data)
+
+    def close(self):
+        if self.buf:
+            self._submit(bytes(self.buf))
+            self.buf = bytearray()
+        while self.pending:
+            self._write_one()
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.pool.shutdown(cancel_futures=True)
+
+
+def relay(src, dest, blocksize=BLOCKSIZE):
+    '''Copy src to dest in blocks. Returns number of bytes copied'''
+    total = 0
+    while True:
+        data = src.read(blocksize)
+        if not data:
+            return total
+        dest.write(data)
+        total += len(data)
+
+
+def mysql_auth_args(db):
+    return ['-u', db['USER'], '--password={}'.format(db['PASSWORD'])]
+
+
+class HashingWriter(object):
+    '''Wraps a file, keeping a sha256 and byte count of what is written'''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.sha256.update(data)
+        self.bytes += len(data)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def iter_gunzip(chunks):
+    '''Decompress an iterable of gzip chunks, multi-member files included
+
+    Raises EOFError if the input stops in the middle of a member, as a
+    dropped dump stream would.
+    '''
+    decompressor = zlib.decompressobj(31)
+    in_member = False
+    for chunk in chunks:
+        while chunk:
+            in_member = True
+            yield decompressor.decompress(chunk)
+            if decompressor.eof:
+                # start of the next gzip member (ParallelGzipWriter, pigz)
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(31)
+                in_member = False
+            else:
+                chunk = b''
+    yield decompressor.flush()
+    if in_member:
+        raise EOFError('gzip stream ended in the middle of a member')
+
+
+def iter_file(f, size=None, blocksize=BLOCKSIZE):
+    '''Read f in blocks, stopping after size bytes if size is given'''
+    while size is None or size > 0:
+        n = blocksize if size is None else min(blocksize, size)
+        data = f.read(n)
+        if not data:
+            return
+        if size is not None:
+            size -= len(data)
+        yield data
+
+
+_CREATE_TABLE_RE = re.compile(r'^CREATE TABLE `([^`]+)` \($(.*?)^\)(.*?);$',
+                              re.M | re.S)
+_DEFERRED_RE = re.compile(r'^\s+((UNIQUE |FULLTEXT |SPATIAL )?KEY |CONSTRAINT )')
+
+
+def split_schema(sql):
+    '''Pull secondary indexes and foreign keys out of mysqldump DDL
+
+    Returns (schema, post): schema creates the tables with only their
+    primary keys, post has the ALTER TABLE statements that add the rest
+    back once the data is in. Tables without a primary key are left as
+    they are.
+    '''
+    keys = []
+    constraints = []
+
+    def strip(match):
+        table, body, tail = match.groups()
+        lines = body.strip('\n').split('\n')
+        if not any(l.strip().startswith('PRIMARY KEY') for l in lines):
+            return match.group(0)
+        kept = []
+        for line in lines:
+            definition = line.strip().rstrip(',')
+            m = _DEFERRED_RE.match(line)
+            if m and m.group(1) == 'CONSTRAINT ':
+                constraints.append((table, definition))
+            elif m:
+                keys.append((table, definition))
+            else:
+                kept.append(definition)
+        return 'CREATE TABLE `{}` (\n  {}\n){};'.format(
+            table, ',\n  '.join(kept), tail)
+
+    schema = _CREATE_TABLE_RE.sub(strip, sql)
+    post = ['SET FOREIGN_KEY_CHECKS=0;']
+    for deferred in (keys, constraints):
+        by_table = {}
+        for table, definition in deferred:
+            by_table.setdefault(table, []).append('ADD ' + definition)
+        for table, adds in by_table.items():
+            post.append('ALTER TABLE `{}` {};'.format(table, ', '.join(adds)))
+    post.append('SET FOREIGN_KEY_CHECKS=1;')
+    return schema, '\n'.join(post) + '\n'
+
+
+def dump_filename(path, sharded=False):
+    '''The file dumpdb writes for --output=path: x.sql.gz, or x.sql.tar if
+    sharded. path may be given with either extension, or without.'''
+    for ext in ('.gz', '.tar'):
+        if path.endswith(ext):
+            path = path[:-len(ext)]
+            break
+    return path + ('.tar' if sharded else '.gz')
+
+
+def is_sharded_dump(path):
+    return path.endswith('.tar') and tarfile.is_tarfile(path)
+
+
+def read_manifest(tar):
+    return json.load(tar.extractfile(MANIFEST))
+
+
+_TABLE_RE = re.compile(rb'^(?:CREATE TABLE|LOCK TABLES|INSERT INTO) `([^`]+)`',
+                       re.M)
+
+
+class LoadProgress(object):
+    '''Counts a restore as it streams through, logging progress
+
+        progress = LoadProgress(getsize(dbfile), log=logger.info)
+        sql = progress.sql(iter_gunzip(progress.compressed(iter_file(f))))
+
+    Logs every interval seconds: the table being loaded, bytes and
+    statements so far, rate, and (if total_bytes, the compressed size,
+    is known) the ETA. Time and bytes are also totalled per table.
+    Since the loader only takes data as fast as it can load it, a
+    table's time is roughly its load time.
+    '''
+    def __init__(self, total_bytes=None, interval=10, log=print):
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.log = log
+        self.compressed_bytes = 0
+        self.sql_bytes = 0
+        self.statements = 0
+        self.table = None
+        self.tables = {}              # name -> [bytes, seconds]
+        self.start = self.table_start = self.last_log = time.time()
+        self.table_bytes = 0
+        self._last_byte = b''
+
+    def compressed(self, chunks):
+        for chunk in chunks:
+            self.compressed_bytes += len(chunk)
+            yield chunk
+
+    def sql(self, chunks):
+        for chunk in chunks:
+            self.sql_bytes += len(chunk)
+            # statements end a line with ;
+            self.statements += chunk.count(b';\n') + (
+                self._last_byte == b';' and chunk[:1] == b'\n')
+            self._last_byte = chunk[-1:] or self._last_byte
+            for match in _TABLE_RE.finditer(chunk):
+                name = match.group(1).decode('utf8')
+                if name != self.table:
+                    self._switch_table(name)
+            yield chunk
+            if time.time() - self.last_log >= self.interval:
+                self.log_progress()
+        self._switch_table(None)
+
+    def _switch_table(self, name):
+        now = time.time()
+        if self.table is not None:
+            entry = self.tables.setdefault(self.table, [0, 0.0])
+            entry[0] += self.sql_bytes - self.table_bytes
+            entry[1] += now - self.table_start
+        self.table, self.table_start, self.table_bytes = \
+            name, now, self.sql_bytes
+
+    def log_progress(self):
+        self.last_log = now = time.time()
+        elapsed = max(now - self.start, 1e-6)
+        eta = ''
+        if self.total_bytes and self.compressed_bytes:
+            done = self.compressed_bytes / self.total_bytes
+            eta = ', {:.0%} ETA {:.0f}s'.format(
+                done, elapsed * (1 - done) / done)
+        self.log('{table}: {sql} SQL ({compressed} compressed), '
+                 '{statements} statements, {rate}/s{eta}'.format(
+                     table=self.table or '-',
+                     sql=human_bytes(self.sql_bytes),
+                     compressed=human_bytes(self.compressed_bytes),
+                     statements=self.statements,
+                     rate=human_bytes(self.sql_bytes / elapsed),
+                     eta=eta))
+
+    def record(self):
+        '''Totals as a JSON-able dict, slowest tables first'''
+        return dict(
+            seconds=round(time.time() - self.start, 3),
+            compressed_bytes=self.compressed_bytes,
+            sql_bytes=self.sql_bytes,
+            statements=self.statements,
+            tables=[dict(name=name, bytes=size, seconds=round(seconds, 3))
+                    for name, (size, seconds) in sorted(
+                        self.tables.items(), key=lambda t: -t[1][1])])
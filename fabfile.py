@@ -46,15 +46,22 @@ import inspect
 from datetime import datetime
 from functools import wraps
 from itertools import chain
-from os.path import expanduser, lexists, join, dirname
+from os.path import expanduser, lexists, join, dirname, basename
 from shutil import move
 from os import symlink, remove, getcwd
 import re
 import sys
 
 from fabric.api import *
+from fabric.state import connections
 from fabric2 import Connection
 
+from .mediaindex import incremental_sync
+from .mediastore import MediaStore
+from .parallel import run_processes, DEFAULT_WORKERS
+from .tagsgen import build_tags
+from .transfer import fetch, parse_sha256sum, STREAMS
+
 # see below for default value of env.apps
 
 
@@ -128,19 +135,45 @@ def apps(*apps):
     env.apps = list(chain.from_iterable(appmap(a) for a in apps))
 
 
+def _run_for_app(app, projdir, f, args, kwargs):
+    with settings(host_string=app.host,
+                  app=app):
+        with cd(app.projdir if projdir else app.dir):
+            if app.prefix:
+                with prefix(app.prefix):
+                    f(*args, **kwargs)
+            else:
+                f(*args, **kwargs)
+
+
+def _fresh_connections():
+    '''Forked workers must not share the parent's ssh connections'''
+    connections.clear()
+
+
 def ftask(projdir=False, apps=None, cmd_category=None):
+    '''Run the task once per app
+
+    With fab -P (env.parallel) the apps run concurrently, at most
+    env.pool_size (fab -z) at a time, each with its output buffered and
+    prefixed, followed by a per-app summary.'''
     def dec(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            for app in appmap(apps) if apps else env.apps:
-                with settings(host_string=app.host,
-                              app=app):
-                    with cd(app.projdir if projdir else app.dir):
-                        if app.prefix:
-                            with prefix(app.prefix):
-                                f(*args, **kwargs)
-                        else:
-                            f(*args, **kwargs)
+            app_list = list(appmap(apps) if apps else env.apps)
+            if env.parallel and len(app_list) > 1:
+                results = run_processes(
+                    [(str(app), _run_for_app,
+                      (app, projdir, f, args, kwargs), {})
+                     for app in app_list],
+                    workers=int(env.pool_size or DEFAULT_WORKERS),
+                    initializer=_fresh_connections)
+                if not all(r.ok for r in results):
+                    abort('Failed on {} app(s)'.format(
+                        sum(not r.ok for r in results)))
+            else:
+                for app in app_list:
+                    _run_for_app(app, projdir, f, args, kwargs)
         wrapper.cmd_category = cmd_category
         return wrapper
     return dec
@@ -168,38 +201,10 @@ def all():
 
 
 @cmd_category('Local only')
-def tags():
-    '''Re-build tags table for emacs'''
-    local('find . -path "*migrations" -prune '
-          '-o -name \*.html -print '
-          '-o -name \*.py -print '
-          '-o -name \*.js -print '
-          '-o -name \*.sass -print '
-          '| etags -')
-    local('find . -path ./autoevals -prune -path "*migrations" -prune '
-          '-o -name \*.html -print '
-          '-o -name \*.py -print '
-          '-o -name \*.js -print '
-          '-o -name \*.sass -print '
-          '| etags -o TAGS_NOEVALS -')
-    local('find . -path "*migrations" -prune '
-          '-o -name \*.py -print '
-          '-o -name \*.sass -print '
-          '| etags -o TAGS_NOHTMLNOJS -')
-    local('find . -path ./autoevals -prune -path "*migrations" -prune '
-          '-o -name \*.js -print '
-          '-o -name \*.sass -print '
-          '-o -name \*.html -print '
-          '| etags -o TAGS_ONLYJSHTML -')
-    local('find . -path ./autoevals -prune -path "*migrations" -prune '
-          '-o -name \*.py -print '
-          '-o -name \*.sass -print '
-          '| etags -o TAGS_ONLYPY -')
-    local('find . -path ./autoevals -prune -path "*migrations" -prune '
-          '-o -name \*.py -print '
-          '-o -name \*.html -print '
-          '-o -name \*.sass -print '
-          '| etags -o TAGS_ONLYPYHTML -')
+def tags(incremental=None):
+    '''Re-build tags table for emacs. {incremental}: changed files only'''
+    print('{files} files, {parsed} parsed in {seconds:.1f}s'.format(
+        **build_tags('.', incremental=bool(incremental))))
 
 
 @localtask
@@ -322,26 +327,40 @@ def move_and_link(src, dest):
 
 
 @projtask
-def getdbonly(db_dest_file=None):
-    '''Get db (no media) from projects and place them in env.backups_dir & ~'''
+def getdbonly(db_dest_file=None, streams=STREAMS, reuse=None):
+    '''Get db (no media) from projects and place them in env.backups_dir & ~
+
+    Resumable download over {streams} SFTP streams, checked against the
+    server's sha256. Skipped if today's backup is already identical.
+    {reuse}=True downloads the dump already on the server, if any,
+    instead of dumping again'''
     db_dest_file = db_dest_file or app_to_dbfilename(env.app)
-    _dumpdb(db_dest_file)
+    if not (reuse and run('test -f {}'.format(db_dest_file), quiet=True,
+                          warn_only=True).succeeded):
+        _dumpdb(db_dest_file)
     local_db_dest_file = expanduser(db_dest_file)
+    backup_file = expanduser('{}/{}/db{}.sql.gz'.format(
+        env.backups_dir,
+        env.app.name,
+        datetime.now().strftime('%d%b%Y')))
+    sha256 = parse_sha256sum(run('sha256sum {}'.format(db_dest_file),
+                                 quiet=True))
+    stats = fetch(connections[env.host_string].open_sftp, db_dest_file,
+                  backup_file, sha256, streams=int(streams))
+    print('{status} {bytes} bytes ({resumed} resumed) in {seconds:.1f}s'
+          .format(**stats))
     if lexists(local_db_dest_file):
         remove(local_db_dest_file)
-        # otherwise get tries to overwrite the linked file!
-    get(db_dest_file, local_db_dest_file)
-    move_and_link(local_db_dest_file,
-                  expanduser(
-                      '{}/{}/db{}.sql.gz'.format(
-                          env.backups_dir,
-                          env.app.name,
-                          datetime.now().strftime('%d%b%Y'))))
+    symlink(backup_file, local_db_dest_file)
 
 
 @projtask
-def getmediaonly(db_dest_file=None, media_dest_file=None):
-    '''Get media (no db) from projects and place them env.backups_dir & ~'''
+def getmediaonly(db_dest_file=None, media_dest_file=None, incremental=None,
+                 snapshot=None):
+    '''Get media (no db) from projects and place them env.backups_dir & ~
+
+    {incremental}=True copies only files changed since the last sync
+    {snapshot}=True stores a deduplicated snapshot instead of a .tgz'''
     backup_dir = '{env.backups_dir}/{env.app.name}'.format(env=env)
 
     media_dir = managepy('mediadir')
@@ -353,19 +372,36 @@ def getmediaonly(db_dest_file=None, media_dest_file=None):
         backup_dir=backup_dir,
         timestamp=datetime.now().strftime('%d%b%Y'))
 
-    local("rsync -avz -e ssh {media_src} {media_dest}".format(
+    if incremental:
+        index = managepy('mediaindex').strip().splitlines()[-1]
+        incremental_sync(
+            fetch_index=lambda local_path: get(index, local_path),
+            run=local,
             media_src=media_src,
-            media_dest=media_dest))
-
-    local("tar -czf {media_zip} --directory {media_dest} .&".format(
-            media_zip=media_zip,
-            media_dest=media_dest))
+            media_dest=expanduser(media_dest + basename(media_dir)),
+            state_path=expanduser(backup_dir + '/media-index.sqlite'))
+    else:
+        local("rsync -avz -e ssh {media_src} {media_dest}".format(
+                media_src=media_src,
+                media_dest=media_dest))
+
+    if snapshot:
+        # export with: python mediastore.py <store> export <name> <out.tgz>
+        stats = MediaStore(expanduser(backup_dir + '/media-store')).snapshot(
+            expanduser(media_dest))
+        print('media snapshot {name}: {files} files, {read} read, '
+              '{written} bytes new'.format(**stats))
+    else:
+        local("tar -czf {media_zip} --directory {media_dest} .&".format(
+                media_zip=media_zip,
+                media_dest=media_dest))
     local("rm -rf site_media")
     local("ln -s {}site_media/ site_media".format(media_dest))
-    local("ln -f -s {media_zip} {home_zip}".format(
-            media_zip=media_zip,
-            home_zip=expanduser('~/u/{}-media.tgz'.format(
-                    env.app.name))))
+    if not snapshot:
+        local("ln -f -s {media_zip} {home_zip}".format(
+                media_zip=media_zip,
+                home_zip=expanduser('~/u/{}-media.tgz'.format(
+                        env.app.name))))
 
 
 @cmd_category('Local only')
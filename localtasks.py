@@ -5,6 +5,7 @@ from os import symlink
 from os.path import join, dirname
 
 from . import djtasks
+from .tagsgen import build_tags
 
 @task
 def autoconfig(c, force=False):
@@ -45,39 +46,13 @@ def forcelocal(c):
 
 
 @task
-def tags(c):
-    '''Re-build tags table for emacs'''
+def tags(c, incremental=False):
+    '''Re-build tags table for emacs
+
+    incremental: only re-parse files changed since the last run'''
     forcelocal(c)
-    c.run('find . -path "*migrations" -prune '
-          '-o -name \*.html -print '
-          '-o -name \*.py -print '
-          '-o -name \*.js -print '
-          '-o -name \*.sass -print '
-          '| etags -')
-    c.run('find . -path ./autoevals -prune -path "*migrations" -prune '
-          '-o -name \*.html -print '
-          '-o -name \*.py -print '
-          '-o -name \*.js -print '
-          '-o -name \*.sass -print '
-          '| etags -o TAGS_NOEVALS -')
-    c.run('find . -path "*migrations" -prune '
-          '-o -name \*.py -print '
-          '-o -name \*.sass -print '
-          '| etags -o TAGS_NOHTMLNOJS -')
-    c.run('find . -path ./autoevals -prune -path "*migrations" -prune '
-          '-o -name \*.js -print '
-          '-o -name \*.sass -print '
-          '-o -name \*.html -print '
-          '| etags -o TAGS_ONLYJSHTML -')
-    c.run('find . -path ./autoevals -prune -path "*migrations" -prune '
-          '-o -name \*.py -print '
-          '-o -name \*.sass -print '
-          '| etags -o TAGS_ONLYPY -')
-    c.run('find . -path ./autoevals -prune -path "*migrations" -prune '
-          '-o -name \*.py -print '
-          '-o -name \*.html -print '
-          '-o -name \*.sass -print '
-          '| etags -o TAGS_ONLYPYHTML -')
+    print('{files} files, {parsed} parsed in {seconds:.1f}s'.format(
+        **build_tags('.', incremental=incremental)))
 
 
 @task
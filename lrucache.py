@@ -0,0 +1,48 @@
+'''Small thread-safe LRU cache with optional TTL and hit/miss counters'''
+from collections import OrderedDict
+import threading
+import time
+
+_missing = object()
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=1024, ttl=None):
+        '''ttl: seconds an entry stays valid, None for no expiry'''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            expires, value = self.data.get(key, (None, _missing))
+            if value is not _missing and expires is not None \
+               and expires < time.monotonic():
+                del self.data[key]
+                value = _missing
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.data[key] = (expires, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self.data), maxsize=self.maxsize)
@@ -0,0 +1,227 @@
+'''Send mail in the background instead of on the request thread
+
+    from dutils.mailqueue import send_async
+    future = send_async('sendgrid_send', subject, message, from_email, [to])
+
+The named send_mail function is called on a pool of worker threads.
+send_async returns at once with a concurrent.futures.Future.
+Retryable failures (429s, 5xx, server unreachable) are retried with
+backoff.
+
+With settings.MAIL_SPOOL_DIR set, every message is also written to the
+spool directory until it has been sent, so a crash or restart does not
+lose it. Spooled messages left behind by dead processes are picked up
+when the queue next starts. Messages that still fail after all retries
+are moved to MAIL_SPOOL_DIR/failed; `manage.py mailspool --retry-failed`
+sends them again. Spooled arguments must be JSON serialisable.
+
+Settings: MAIL_QUEUE_WORKERS (default 2), MAIL_SPOOL_DIR (default None),
+MAIL_QUEUE_RETRIES (default 5).
+'''
+import atexit
+from concurrent.futures import Future
+import fcntl
+import json
+import logging
+import os
+from os.path import join
+import queue
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from . import send_mail
+from .dumputils import atomic_output
+
+logger = logging.getLogger(__name__)
+
+SEND_FUNCTIONS = ('sendgrid_send', 'sendgrid_send_template',
+                  'sendgrid_send_bulk', 'sendgrid_send_template_bulk',
+                  'mandrill_send')
+
+
+class MailQueue(object):
+    def __init__(self, workers=2, spool_dir=None, retries=5, backoff=2.0):
+        self.workers = workers
+        self.spool_dir = spool_dir
+        self.retries = retries
+        self.backoff = backoff
+        self.jobs = queue.Queue()
+        self.threads = []
+        # spool files are named <token>-<id>.json. The queue holds a lock
+        # on owners/<token>.lock while it lives (see _owner_alive)
+        self.token = uuid.uuid4().hex
+        self._owner_lock = None
+        if spool_dir:
+            os.makedirs(join(spool_dir, 'failed'), exist_ok=True)
+            os.makedirs(join(spool_dir, 'owners'), exist_ok=True)
+            self._owner_lock = open(self._owner_path(self.token), 'w')
+            fcntl.lockf(self._owner_lock, fcntl.LOCK_EX)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True,
+                                      name='mailqueue-{}'.format(i))
+            thread.start()
+            self.threads.append(thread)
+        if self.spool_dir:
+            self.recover()
+        return self
+
+    def submit(self, func_name, *args, **kwargs):
+        '''Queue send_mail.func_name(*args, **kwargs). Returns a Future'''
+        if func_name not in SEND_FUNCTIONS:
+            raise ValueError('Unknown send function {}'.format(func_name))
+        job = dict(func=func_name, args=args, kwargs=kwargs)
+        spool_path = self._spool(job) if self.spool_dir else None
+        future = Future()
+        self.jobs.put((job, spool_path, future))
+        return future
+
+    def _owner_path(self, token):
+        return join(self.spool_dir, 'owners', token + '.lock')
+
+    def _owner_alive(self, token):
+        '''Whether the queue that spooled token's files still runs
+
+        Its lock goes away with its process, however that ends, and
+        unlike a pid it is never reused. (lockf locks, unlike flock ones,
+        are not inherited by forked children.)
+        '''
+        if token == self.token:
+            return True
+        try:
+            f = open(self._owner_path(token), 'r+')
+        except FileNotFoundError:
+            return False
+        with f:
+            try:
+                fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return True
+        return False
+
+    def _spool(self, job):
+        path = join(self.spool_dir, '{}-{}.json'.format(self.token,
+                                                        uuid.uuid4().hex))
+        with atomic_output(path, 'w') as f:
+            json.dump(job, f)
+        return path
+
+    def recover(self):
+        '''Queue spooled messages whose process died before sending them'''
+        count = 0
+        alive = {}
+        for name in sorted(os.listdir(self.spool_dir)):
+            token, sep, rest = name.partition('-')
+            if not name.endswith('.json') or not sep:
+                continue
+            if token not in alive:
+                alive[token] = self._owner_alive(token)
+            if alive[token]:
+                continue
+            # claim it: the rename succeeds for only one process
+            path = join(self.spool_dir, '{}-{}'.format(self.token, rest))
+            try:
+                os.rename(join(self.spool_dir, name), path)
+            except FileNotFoundError:
+                continue
+            with open(path) as f:
+                job = json.load(f)
+            self.jobs.put((job, path, Future()))
+            count += 1
+        for token in [t for t, is_alive in alive.items() if not is_alive]:
+            try:
+                os.remove(self._owner_path(token))
+            except FileNotFoundError:
+                pass
+        if count:
+            logger.info('Recovered {} spooled messages'.format(count))
+        return count
+
+    def retry_failed(self):
+        '''Queue the messages that failed all their retries earlier'''
+        failed_dir = join(self.spool_dir, 'failed')
+        names = sorted(n for n in os.listdir(failed_dir)
+                       if n.endswith('.json'))
+        for name in names:
+            path = join(self.spool_dir, '{}-{}'.format(
+                self.token, name.partition('-')[2]))
+            os.rename(join(failed_dir, name), path)
+            with open(path) as f:
+                self.jobs.put((json.load(f), path, Future()))
+        return len(names)
+
+    def _work(self):
+        while True:
+            job, spool_path, future = self.jobs.get()
+            try:
+                if not future.set_running_or_notify_cancel():
+                    if spool_path:
+                        os.remove(spool_path)
+                    continue
+                try:
+                    result = send_mail.send_with_retry(
+                        self._call, job, retries=self.retries,
+                        backoff=self.backoff)
+                except Exception as e:
+                    logger.exception('Could not send mail: {}'.format(
+                        job['func']))
+                    if spool_path:
+                        os.rename(spool_path, join(
+                            self.spool_dir, 'failed',
+                            os.path.basename(spool_path)))
+                    future.set_exception(e)
+                else:
+                    if spool_path:
+                        os.remove(spool_path)
+                    future.set_result(result)
+            finally:
+                self.jobs.task_done()
+
+    def _call(self, job):
+        func = getattr(send_mail, job['func'])
+        return func(*job['args'], **job['kwargs'])
+
+    def flush(self, timeout=None):
+        '''Wait until everything queued so far has been handled'''
+        deadline = time.monotonic() + timeout if timeout else None
+        while self.jobs.unfinished_tasks:
+            if deadline and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+
+_queue = None
+_queue_pid = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    '''The process's MailQueue, started on first use (and after fork)'''
+    global _queue, _queue_pid
+    if _queue is None or _queue_pid != os.getpid():
+        with _queue_lock:
+            if _queue is None or _queue_pid != os.getpid():
+                _queue = MailQueue(
+                    workers=getattr(settings, 'MAIL_QUEUE_WORKERS', 2),
+                    spool_dir=getattr(settings, 'MAIL_SPOOL_DIR', None),
+                    retries=getattr(settings, 'MAIL_QUEUE_RETRIES', 5),
+                ).start()
+                _queue_pid = os.getpid()
+    return _queue
+
+
+def send_async(func_name, *args, **kwargs):
+    '''Queue a send_mail function call, return a Future for its result'''
+    return get_queue().submit(func_name, *args, **kwargs)
+
+
+@atexit.register
+def _flush_at_exit():
+    # anything still queued is in the spool (if any) for the next start
+    if _queue is not None and _queue_pid == os.getpid():
+        _queue.flush(timeout=10)
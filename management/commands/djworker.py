@@ -0,0 +1,150 @@
+import json
+import os
+from os.path import abspath, dirname, getmtime
+import socket
+import sys
+import time
+import traceback
+
+from django.core.management import ManagementUtility
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from dutils.djclient import ACK, socket_path
+
+CHECK_INTERVAL = 2            # seconds between checks for code changes
+
+
+class Command(BaseCommand):
+    '''Keep django loaded and run manage.py commands sent over a socket
+
+    Normally started by `python dutils/djclient.py --start ...`; see
+    djclient.py for the client side. Each command runs in a child
+    forked from this process, so it starts with django already set up
+    and leaves nothing behind. Output (stdout and stderr, together) is
+    streamed back, followed by the exit status.
+
+    The worker re-executes itself when a .py file of the project that
+    it has loaded changes, and exits after --idle-timeout seconds
+    without a command.
+    '''
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', help='default: from the current dir')
+        parser.add_argument('--idle-timeout', type=int, default=3600)
+
+    def handle(self, **options):
+        path = options['socket'] or socket_path(os.getcwd())
+        os.makedirs(dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(path)
+        finally:
+            os.umask(old_umask)
+        server.listen(16)
+        server.settimeout(CHECK_INTERVAL)
+        # children must not share the parent's database connections
+        connections.close_all()
+        mtimes = self.source_mtimes()
+        last_used = time.time()
+        print('djworker {} listening on {}'.format(os.getpid(), path),
+              flush=True)
+
+        try:
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    conn = None
+                self.reap()
+                if mtimes != self.source_mtimes():
+                    print('djworker: code changed, reloading', flush=True)
+                    server.close()
+                    os.remove(path)
+                    if conn:
+                        conn.close()      # client runs the command itself
+                    os.execv(sys.executable, [sys.executable] + sys.argv)
+                if conn is None:
+                    if time.time() - last_used > options['idle_timeout']:
+                        print('djworker: idle, exiting', flush=True)
+                        return
+                    continue
+                last_used = time.time()
+                if self.serve(server, conn):
+                    return
+        finally:
+            server.close()
+            if os.path.exists(path):
+                os.remove(path)
+
+    def source_mtimes(self):
+        '''mtimes of the project .py files loaded in this process'''
+        root = abspath(os.getcwd()) + os.sep
+        mtimes = {}
+        for module in list(sys.modules.values()):
+            filename = getattr(module, '__file__', None)
+            if filename and abspath(filename).startswith(root):
+                try:
+                    mtimes[filename] = getmtime(filename)
+                except OSError:
+                    mtimes[filename] = None
+        return mtimes
+
+    def reap(self):
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except ChildProcessError:
+            pass
+
+    def serve(self, server, conn):
+        '''Fork a child to run the request. Returns True to stop'''
+        conn.settimeout(CHECK_INTERVAL * 5)
+        try:
+            with conn.makefile('rb') as f:
+                message = json.loads(f.readline().decode('utf8') or '{}')
+        except (OSError, ValueError):
+            conn.close()
+            return False
+        conn.settimeout(None)
+        try:
+            # from here on the client will not run the command itself
+            conn.sendall(ACK)
+        except OSError:
+            conn.close()
+            return False
+        if message.get('stop'):
+            conn.sendall(b'djworker stopping\n\0EXIT 0\n')
+            conn.close()
+            return True
+        if os.fork():
+            conn.close()
+            return False
+
+        # child
+        server.close()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(conn.fileno(), 1)
+        os.dup2(conn.fileno(), 2)
+        code = 0
+        try:
+            ManagementUtility(['manage.py'] + message.get('argv', [])).execute()
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            connections.close_all()
+            conn.sendall(b'\0EXIT %d\n' % code)
+        finally:
+            os._exit(0)
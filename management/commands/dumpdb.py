@@ -1,10 +1,27 @@
-from os.path import expanduser, dirname, basename
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from datetime import datetime
+import json
+from os.path import expanduser, dirname, basename, getsize, join
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import connection
 
 import subprocess
 
+from dutils.dumputils import (atomic_output, cpu_count, dump_filename,
+                              human_bytes, relay, iter_file,
+                              ParallelGzipWriter, HashingWriter, mysql_auth_args, split_schema,
+                              MANIFEST, SCHEMA_MEMBER, POST_MEMBER)
+from dutils.tablefilter import TableRules
+
 
 class Command(BaseCommand):
      project_name = basename(dirname(dirname(dirname(dirname(__file__)))))
@@ -12,15 +29,97 @@ class Command(BaseCommand):
           parser.add_argument(
                '--output',
                default='~/{}.sql'.format(Command.project_name),
-               help='output file')
+               help='output file, - for a compressed stream on stdout '
+               '(implies --stream)')
+          parser.add_argument(
+               '--stream',
+               action='store_true',
+               help='pipe mysqldump straight into a parallel compressor '
+               '(no intermediate uncompressed file)')
+          parser.add_argument(
+               '--compressor',
+               choices=['auto', 'pigz', 'python'],
+               default='auto',
+               help='compressor for --stream. auto uses pigz if installed, '
+               'else compresses in-process on a thread pool')
+          parser.add_argument(
+               '--threads',
+               type=int,
+               default=cpu_count(),
+               help='compression threads for --stream')
+          parser.add_argument(
+               '--sharded',
+               action='store_true',
+               help='write <output>.tar with one compressed file per table '
+               'and a manifest, for parallel restore by replacedb')
+          parser.add_argument(
+               '--jobs',
+               type=int,
+               default=cpu_count(),
+               help='tables dumped concurrently for --sharded')
+          parser.add_argument(
+               '--filter',
+               action='append',
+               help='TABLE=exclude|schema|recent:N[:COLUMN]|where:CONDITION, '
+               'see dutils/tablefilter.py. Not for backups!')
+          parser.add_argument(
+               '--filter-file',
+               help='JSON file of {TABLE: ACTION} filter rules')
+
+     def mysqldump_cmd(self, db, *options):
+          # no dump date (nor gzip name/mtime): unchanged data gives an
+          # identical file, which getdbonly then need not download again
+          return (['mysqldump', '--skip-dump-date'] + mysql_auth_args(db)
+                  + list(options) + [db['NAME']])
+
+     def dump_commands(self, db, rules):
+          '''mysqldump commands whose outputs, concatenated, are the dump'''
+          if not rules:
+               return [self.mysqldump_cmd(db)]
+          tables = connection.introspection.table_names()
+          connection.close()
+          return [self.mysqldump_cmd(db, *options) + run_tables
+                  for options, run_tables
+                  in rules.mysqldump_runs(db['NAME'], tables)]
+
+     def run_dumps(self, commands, dest):
+          '''Run the mysqldumps in turn into dest. Returns bytes copied'''
+          total = 0
+          for cmd in commands:
+               dumpproc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+               try:
+                    total += relay(dumpproc.stdout, dest)
+               except BaseException:
+                    dumpproc.kill()
+                    dumpproc.wait()
+                    raise
+               if dumpproc.wait() != 0:
+                    raise CommandError(
+                         'mysqldump failed: {}'.format(dumpproc.returncode))
+          return total
 
      def handle(self, *args, **options):
           db = settings.DATABASES['default']
-          outfile = expanduser(options['output'])
-          if outfile.endswith('.gz'):
-               outfile = outfile[:-3]
-          outfile_gz = outfile + '.gz'
+          self.rules = TableRules.load(options['filter_file'],
+                                       options['filter'])
+          if options['output'] == '-':
+               return self.stream_dump(db, None, options)
+          output = expanduser(options['output'])
+          if options['sharded']:
+               return self.sharded_dump(
+                    db, dump_filename(output, sharded=True), options)
+          outfile_gz = dump_filename(output)
+          outfile = outfile_gz[:-len('.gz')]
+          if options['stream']:
+               return self.stream_dump(db, outfile_gz, options)
+          if self.rules:
+               with open(outfile, 'wb') as out:
+                    self.run_dumps(self.dump_commands(db, self.rules), out)
+               subprocess.call(['rm', '-f', outfile_gz])
+               subprocess.call(['gzip', '-n', outfile])
+               return
           subprocess.call(['mysqldump',
+                           '--skip-dump-date',
                            '-r',
                            outfile,
                            '-u',
@@ -28,4 +127,176 @@ class Command(BaseCommand):
                            '--password=%s' % (db['PASSWORD'],),
                            db['NAME']])
           subprocess.call(['rm', '-f', outfile_gz])
-          subprocess.call(['gzip', outfile])
+          subprocess.call(['gzip', '-n', outfile])
+
+     def stream_dump(self, db, outfile_gz, options):
+          '''mysqldump | compressor > tmpfile, then rename to outfile_gz
+
+          With outfile_gz None, the compressed dump goes to stdout.
+          '''
+          compressor = options['compressor']
+          if compressor == 'auto':
+               compressor = 'pigz' if shutil.which('pigz') else 'python'
+          threads = options['threads']
+
+          start = time.time()
+          commands = self.dump_commands(db, self.rules)
+          if outfile_gz:
+               output = atomic_output(outfile_gz)
+          else:
+               output = contextlib.nullcontext(sys.stdout.buffer)
+          with output as out:
+               if compressor == 'pigz':
+                    zipproc = subprocess.Popen(
+                         ['pigz', '-n', '-p', str(threads), '-c'],
+                         stdin=subprocess.PIPE, stdout=out)
+                    try:
+                         raw_bytes = self.run_dumps(commands, zipproc.stdin)
+                    finally:
+                         zipproc.stdin.close()
+                         zipproc.wait()
+                    if zipproc.returncode != 0:
+                         raise CommandError(
+                              'pigz failed: {}'.format(zipproc.returncode))
+               else:
+                    with ParallelGzipWriter(out, threads=threads) as zout:
+                         raw_bytes = self.run_dumps(commands, zout)
+               out.flush()
+
+          elapsed = max(time.time() - start, 1e-6)
+          if outfile_gz:
+               gz_bytes = getsize(outfile_gz)
+               dest = '{} (compression ratio {:.2f})'.format(
+                    human_bytes(gz_bytes), raw_bytes / max(gz_bytes, 1))
+          else:
+               dest = 'stdout'
+          self.stderr.write(
+               'Dumped {raw} into {dest} ({compressor}, {threads} threads) '
+               'in {elapsed:.1f}s: {rate}/s'
+               .format(raw=human_bytes(raw_bytes),
+                       dest=dest,
+                       compressor=compressor,
+                       threads=threads,
+                       elapsed=elapsed,
+                       rate=human_bytes(raw_bytes / elapsed)))
+
+     def write_gz(self, path, chunks):
+          '''Compress chunks into path, returning (bytes, sha256)'''
+          with open(path, 'wb') as f:
+               hashed = HashingWriter(f)
+               with ParallelGzipWriter(hashed, threads=1) as zout:
+                    for chunk in chunks:
+                         zout.write(chunk)
+          return hashed.bytes, hashed.hexdigest()
+
+     def dump_table(self, db, workdir, table):
+          '''Dump one table's rows into data/TABLE.sql.gz
+
+          rows in the returned manifest entry is approximate: it is
+          counted after the dump, outside its transaction, so on a live
+          database it need not match the data file. It is for logs,
+          not for checking the restore (the sha256 is for that).
+          '''
+          member = 'data/{}.sql.gz'.format(table)
+          rule = self.rules.get(table)
+          where = rule.dump_where() if rule else None
+          options = ['--no-create-info', '--skip-triggers',
+                     '--single-transaction']
+          if where:
+               options.append('--where={}'.format(where))
+          dumpproc = subprocess.Popen(
+               self.mysqldump_cmd(db, *options) + [table],
+               stdout=subprocess.PIPE)
+          try:
+               size, sha256 = self.write_gz(
+                    join(workdir, member), iter_file(dumpproc.stdout))
+          except BaseException:
+               dumpproc.kill()      # may be blocked writing to a full pipe
+               dumpproc.wait()
+               raise
+          if dumpproc.wait() != 0:
+               raise CommandError('mysqldump of {} failed: {}'.format(
+                    table, dumpproc.returncode))
+          with connection.cursor() as cursor:     # approximate, see above
+               if where:
+                    cursor.execute('SELECT COUNT(*) FROM (SELECT 1 FROM `{}` '
+                                   'WHERE {}) AS filtered'.format(table, where))
+               else:
+                    cursor.execute('SELECT COUNT(*) FROM `{}`'.format(table))
+               rows = cursor.fetchone()[0]
+          connection.close()             # one connection per worker thread
+          return dict(name=table, file=member, rows=rows,
+                      bytes=size, sha256=sha256)
+
+     def sharded_dump(self, db, outfile_tar, options):
+          '''One gzipped data file per table, plus schema and manifest
+
+          Secondary indexes and foreign keys are split out of the schema
+          into post.sql.gz, so the restore can load data into bare tables
+          and build the indexes once at the end. The triggers are in
+          post.sql.gz too, so they do not fire during the load.
+          Tables are dumped in separate transactions, so the dump is not
+          a single consistent snapshot across tables.
+          '''
+          start = time.time()
+          all_tables = connection.introspection.table_names()
+          tables = [t for t in all_tables
+                    if self.rules.action(t) != 'exclude']
+          excluded = ['--ignore-table={}.{}'.format(db['NAME'], t)
+                      for t in all_tables
+                      if self.rules.action(t) == 'exclude']
+          connection.close()
+          workdir = tempfile.mkdtemp(dir=dirname(outfile_tar) or '.',
+                                     prefix='.dumpdb-')
+          try:
+               os.mkdir(join(workdir, 'data'))
+               ddl = subprocess.run(self.mysqldump_cmd(db, '--no-data',
+                                                       '--skip-triggers',
+                                                       *excluded),
+                                    stdout=subprocess.PIPE, check=True).stdout
+               # triggers go last, so they do not fire during the load
+               triggers = subprocess.run(
+                    self.mysqldump_cmd(db, '--no-data', '--no-create-info',
+                                       '--no-create-db', '--triggers',
+                                       *excluded),
+                    stdout=subprocess.PIPE, check=True).stdout
+               schema, post = split_schema(ddl.decode('utf8'))
+               post += triggers.decode('utf8')
+               manifest = dict(format=1,
+                               database=db['NAME'],
+                               created=datetime.now().isoformat(),
+                               tables=[])
+               for key, member, sql in (('schema', SCHEMA_MEMBER, schema),
+                                        ('post', POST_MEMBER, post)):
+                    size, sha256 = self.write_gz(join(workdir, member),
+                                                 [sql.encode('utf8')])
+                    manifest[key] = dict(file=member, bytes=size,
+                                         sha256=sha256)
+
+               with ThreadPoolExecutor(options['jobs']) as pool:
+                    manifest['tables'] = list(pool.map(
+                         lambda t: self.dump_table(db, workdir, t),
+                         [t for t in tables
+                          if self.rules.action(t) != 'schema']))
+
+               with open(join(workdir, MANIFEST), 'w') as f:
+                    json.dump(manifest, f, indent=1)
+
+               with atomic_output(outfile_tar) as out:
+                    with tarfile.open(fileobj=out, mode='w') as tar:
+                         tar.add(join(workdir, MANIFEST), MANIFEST)
+                         for entry in ([manifest['schema'], manifest['post']]
+                                       + manifest['tables']):
+                              tar.add(join(workdir, entry['file']),
+                                      entry['file'])
+          finally:
+               shutil.rmtree(workdir)
+
+          self.stderr.write(
+               'Dumped {n} tables (~{rows} rows) into {out} with {jobs} jobs '
+               'in {elapsed:.1f}s'.format(
+                    n=len(manifest['tables']),
+                    rows=sum(t['rows'] for t in manifest['tables']),
+                    out=human_bytes(getsize(outfile_tar)),
+                    jobs=options['jobs'],
+                    elapsed=time.time() - start))
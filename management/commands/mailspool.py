@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dutils.mailqueue import get_queue
+
+
+class Command(BaseCommand):
+    '''Send mail left in MAIL_SPOOL_DIR by processes that died
+
+    With --retry-failed, also resend mail that failed all its retries.
+    Suitable for cron.
+    '''
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='resend messages in MAIL_SPOOL_DIR/failed')
+
+    def handle(self, **options):
+        if not getattr(settings, 'MAIL_SPOOL_DIR', None):
+            raise CommandError('MAIL_SPOOL_DIR is not set')
+        mail_queue = get_queue()          # recovers orphans on start
+        if options['retry_failed']:
+            print('Retrying {} failed messages'.format(
+                mail_queue.retry_failed()))
+        mail_queue.flush()
@@ -0,0 +1,35 @@
+from os.path import abspath, expanduser, dirname, basename
+import os
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+from dutils.mediaindex import MediaIndex
+
+
+class Command(BaseCommand):
+    '''Refresh the content-hash index of MEDIA_ROOT and print its path
+
+    Used by the incremental media sync in tasks.dumpmedia
+    '''
+    project_name = basename(abspath(dirname(dirname(dirname(dirname(
+        __file__))))))
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--index',
+            default='~/.cache/dutils/{}-media.sqlite'.format(
+                Command.project_name),
+            help='index file')
+
+    def handle(self, **options):
+        index_path = expanduser(options['index'])
+        os.makedirs(dirname(index_path), exist_ok=True)
+        index = MediaIndex(index_path)
+        try:
+            stats = index.update(abspath(settings.MEDIA_ROOT))
+        finally:
+            index.close()
+        self.stderr.write('{files} files, {hashed} hashed, {removed} removed '
+                          'in {seconds:.1f}s'.format(**stats))
+        print(index_path)
@@ -0,0 +1,31 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from dutils.modelcache import precompute
+
+
+class Command(BaseCommand):
+    '''Fill a model_cache field for all objects of a model
+
+    manage.py precompute_cache myapp.Company score --workers 4
+    '''
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='app_label.ModelName')
+        parser.add_argument('method', help='model_cache decorated method')
+        parser.add_argument('--all', action='store_true',
+                            help='recompute even where a value exists')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--processes', action='store_true',
+                            help='use forked processes instead of threads')
+
+    def handle(self, **options):
+        model = apps.get_model(options['model'])
+        done = precompute(model._default_manager.all(),
+                          options['method'],
+                          chunk_size=options['chunk_size'],
+                          workers=options['workers'],
+                          processes=options['processes'],
+                          force=options['all'])
+        print('Computed {} {}.{}'.format(done, options['model'],
+                                         options['method']))
@@ -1,4 +1,52 @@
-from django.core.management.base import BaseCommand
+import argparse
+from collections import Counter
+from itertools import islice
+import multiprocessing
+import os
+import traceback
+
+from django.core.management.base import BaseCommand, CommandError
+
+SEPARATOR = '+'
+
+
+def _positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError('must be at least 1')
+    return value
+
+
+def _close_connections():
+    from django.db import connections
+    connections.close_all()
+
+
+def _import(script):
+    return __import__(script, [], [], [' '])
+
+
+def _chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _run_chunk(task):
+    '''(pid, [(item, result, traceback or None)]). Runs in a pool process'''
+    script, chunk, args, kwargs = task
+    run_item = _import(script).run_item
+    results = []
+    for item in chunk:
+        try:
+            results.append((item, run_item(item, *args, **kwargs), None))
+        except Exception:
+            results.append((item, None, traceback.format_exc()))
+    return os.getpid(), results
+
 
 class Command(BaseCommand):
     '''Run a script with django initialized
@@ -8,20 +56,94 @@ class Command(BaseCommand):
     Django will be initialized
 
     Expects arguments as a0 a1 kw1=kwarg1 kw2=kwarg2
+
+    Several scripts can be run in one go, in the same process, separated
+    by a lone +. Django is set up only once:
+        runcmd scripts.a a0 kw1=x + scripts.b + scripts.c b0
+
+    Batch scripts can instead define
+        items(*args, **kwargs)            -> iterable of work items
+        run_item(item, *args, **kwargs)   -> result for one item
+        finish(results, *args, **kwargs)  optional, gets [(item, result)]
+    and runcmd --jobs N runs run_item on N forked processes, sending
+    them --chunk-size items at a time. Items and results must pickle.
+    Results are gathered in item order. Items that raise are reported
+    at the end and make runcmd fail, after finish has had the rest.
+    In a + chain, --jobs applies to each such script; scripts with a
+    plain run() ignore it.
     '''
     def add_arguments(self, parser):
         parser.add_argument('script')
         parser.add_argument('arguments', nargs='*')
+        parser.add_argument('--jobs', type=_positive_int, default=1,
+                            help='processes for items/run_item scripts')
+        parser.add_argument('--chunk-size', type=_positive_int, default=10)
 
     def handle(self, *args, **options):
-        script = options['script']
+        runs = [[options['script']]]
+        for argument in options['arguments']:
+            if argument == SEPARATOR:
+                runs.append([])
+            else:
+                runs[-1].append(argument)
+        for script, *arguments in filter(None, runs):
+            self.run_script(script, arguments, options['jobs'],
+                            options['chunk_size'])
+
+    def run_script(self, script, arguments, jobs=1, chunk_size=10):
         args = []
         kwargs = {}
-        for argument in options['arguments']:
+        for argument in arguments:
             if '=' in argument:
                 key, value = argument.split('=', 1)
                 kwargs[key] = value
             else:
                 args.append(argument)
-        mod = __import__(script, [], [], [' '])
-        mod.run(*args, **kwargs)
+        mod = _import(script)
+        if hasattr(mod, 'run_item'):
+            self.fan_out(script, mod, args, kwargs, jobs, chunk_size)
+        else:
+            mod.run(*args, **kwargs)
+
+    def fan_out(self, script, mod, args, kwargs, jobs, chunk_size):
+        items = mod.items(*args, **kwargs)
+        total = '/{}'.format(len(items)) if hasattr(items, '__len__') else ''
+        tasks = ((script, chunk, args, kwargs)
+                 for chunk in _chunks(items, chunk_size))
+        if jobs > 1:
+            _close_connections()       # never share a connection with children
+            pool = multiprocessing.get_context('fork').Pool(
+                jobs, initializer=_close_connections)
+            chunk_results = pool.imap(_run_chunk, tasks)
+        else:
+            pool = None
+            chunk_results = map(_run_chunk, tasks)
+
+        results, failed, per_worker = [], [], Counter()
+        try:
+            for pid, chunk in chunk_results:
+                per_worker[pid] += len(chunk)
+                for item, result, error in chunk:
+                    if error is None:
+                        results.append((item, result))
+                    else:
+                        failed.append((item, error))
+                self.stderr.write('runcmd: {}: worker {} did {}, {}{} done'
+                                  .format(script, pid, per_worker[pid],
+                                          len(results) + len(failed), total))
+        except BaseException:
+            if pool:
+                pool.terminate()
+            raise
+        if pool:
+            pool.close()
+            pool.join()
+
+        for item, error in failed:
+            self.stderr.write('runcmd: {}: {!r} failed\n{}'.format(
+                script, item, error))
+        if hasattr(mod, 'finish'):
+            mod.finish(results, *args, **kwargs)
+        if failed:
+            raise CommandError('{}: {} of {} items failed'.format(
+                script, len(failed), len(results) + len(failed)))
@@ -0,0 +1,147 @@
+'''Content-hash index of a media tree, for incremental media sync
+
+The server keeps an SQLite index of MEDIA_ROOT (path, size, mtime, sha1),
+refreshed by `manage.py mediaindex`. Only files whose size or mtime
+changed since the last refresh are re-hashed.
+
+The client keeps a copy of the index as of its last successful sync.
+Diffing that against a freshly fetched index gives the files to copy
+and the files to delete, without rsync having to walk and stat both
+trees. Nothing in here imports django.
+'''
+import hashlib
+import os
+from os.path import exists, join, relpath
+import shutil
+import sqlite3
+import tempfile
+import time
+
+HASH_BLOCKSIZE = 1 << 20
+SYNC_BATCH_SIZE = 5000
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCKSIZE), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def walk_files(root):
+    '''Yield (relpath, stat) for every regular file under root'''
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield relpath(entry.path, root), entry.stat()
+
+
+class MediaIndex(object):
+    '''SQLite index of the files under a directory'''
+    def __init__(self, dbpath):
+        self.dbpath = dbpath
+        self.db = sqlite3.connect(dbpath)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files ('
+                        'path TEXT PRIMARY KEY, size INTEGER, '
+                        'mtime INTEGER, hash TEXT)')
+
+    def close(self):
+        self.db.close()
+
+    def entries(self):
+        '''{path: (size, mtime, hash)}'''
+        return {path: (size, mtime, hash) for path, size, mtime, hash
+                in self.db.execute('SELECT path, size, mtime, hash '
+                                   'FROM files')}
+
+    def update(self, root):
+        '''Bring the index up to date with root. Returns a stats dict'''
+        start = time.time()
+        old = self.entries()
+        upserts = []
+        seen = set()
+        for path, st in walk_files(root):
+            seen.add(path)
+            known = old.get(path)
+            if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+                continue
+            upserts.append((path, st.st_size, st.st_mtime_ns,
+                            file_hash(join(root, path))))
+        removed = [(path,) for path in old if path not in seen]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO files '
+                                'VALUES (?, ?, ?, ?)', upserts)
+            self.db.executemany('DELETE FROM files WHERE path = ?', removed)
+        return dict(files=len(seen), hashed=len(upserts),
+                    removed=len(removed), seconds=time.time() - start)
+
+
+def read_entries(dbpath):
+    index = MediaIndex(dbpath)
+    try:
+        return index.entries()
+    finally:
+        index.close()
+
+
+def diff_indexes(old, new):
+    '''(changed, removed) paths going from entries old to entries new
+
+    Files whose content is unchanged are skipped even if their mtime moved.
+    '''
+    changed = [path for path, (size, mtime, hash) in new.items()
+               if old.get(path, (None, None, None))[::2] != (size, hash)]
+    removed = [path for path in old if path not in new]
+    return sorted(changed), sorted(removed)
+
+
+def batches(items, size=SYNC_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def incremental_sync(fetch_index, run, media_src, media_dest, state_path,
+                     batch_size=SYNC_BATCH_SIZE, rsh='ssh'):
+    '''Copy only what changed on the server since the last sync
+
+    fetch_index(local_path): download the freshly updated server index
+    run(cmd): run a shell command locally
+    media_src: host:/path/to/MEDIA_ROOT
+    media_dest: local copy of MEDIA_ROOT
+    state_path: where the index as of the last sync is kept
+    rsh: ssh command for rsync -e
+
+    Without a previous index this falls back to one full rsync.
+    '''
+    os.makedirs(media_dest, exist_ok=True)
+    fd, new_index = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        fetch_index(new_index)
+        if not exists(state_path):
+            run("rsync -a -e '{}' {}/ {}/".format(rsh, media_src, media_dest))
+            changed, removed = None, []
+        else:
+            changed, removed = diff_indexes(read_entries(state_path),
+                                            read_entries(new_index))
+            for batch in batches(changed, batch_size):
+                with tempfile.NamedTemporaryFile('w', suffix='.files') as f:
+                    f.write('\n'.join(batch) + '\n')
+                    f.flush()
+                    run("rsync -a --files-from={} -e '{}' {}/ {}/".format(
+                        f.name, rsh, media_src, media_dest))
+            for path in removed:
+                if exists(join(media_dest, path)):
+                    os.remove(join(media_dest, path))
+        shutil.move(new_index, state_path)
+    finally:
+        if exists(new_index):
+            os.remove(new_index)
+    return dict(full=changed is None,
+                changed=len(changed or []),
+                removed=len(removed))
@@ -0,0 +1,246 @@
+#!/usr/bin/python
+'''Deduplicated, content-addressed media backups
+
+A store is a directory holding
+    objects/ab/cdef...        one blob per distinct chunk (sha256 named)
+    snapshots/NAME.json.gz    one manifest per snapshot
+
+A snapshot lists every file with its size, mtime, mode and chunk ids.
+Files whose size and mtime match the previous snapshot reuse its chunk
+list without being read, and only chunks not already in the store are
+written, so a snapshot costs time and space in proportion to what
+changed since the last one.
+
+Any snapshot can be restored into a directory or exported to a .tgz.
+
+    python mediastore.py STORE snapshot [--name NAME] SRCDIR
+    python mediastore.py STORE list
+    python mediastore.py STORE restore NAME DESTDIR
+    python mediastore.py STORE export NAME OUT.tgz
+    python mediastore.py STORE prune KEEP
+'''
+import argparse
+from collections import deque
+from datetime import datetime
+import gzip
+import hashlib
+import json
+import os
+from os.path import exists, dirname, join
+import tarfile
+import time
+
+try:
+    from .dumputils import atomic_output, human_bytes
+    from .mediaindex import walk_files
+except ImportError:
+    # run as a script
+    from dumputils import atomic_output, human_bytes
+    from mediaindex import walk_files
+
+CHUNK_SIZE = 4 << 20
+SNAPSHOT_SUFFIX = '.json.gz'
+
+
+class ChunkReader(object):
+    '''Read-only file object over a list of chunks (for tarfile.addfile)
+
+    Reads are served from the current chunk at an offset, so reading a
+    chunk in small pieces costs no more than reading it at once.
+    '''
+    def __init__(self, store, chunks):
+        self.store = store
+        self.chunks = deque(chunks)
+        self.buf = b''
+        self.pos = 0
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self.pos == len(self.buf):
+                if not self.chunks:
+                    break
+                self.buf = self.store.read_chunk(self.chunks.popleft())
+                self.pos = 0
+                continue
+            end = len(self.buf) if size < 0 else min(len(self.buf),
+                                                     self.pos + size)
+            pieces.append(self.buf[self.pos:end])
+            if size > 0:
+                size -= end - self.pos
+            self.pos = end
+        return b''.join(pieces)
+
+
+class MediaStore(object):
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = join(root, 'objects')
+        self.snapshots_dir = join(root, 'snapshots')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+
+    def chunk_path(self, chunk_id):
+        return join(self.objects_dir, chunk_id[:2], chunk_id[2:])
+
+    def read_chunk(self, chunk_id):
+        with open(self.chunk_path(chunk_id), 'rb') as f:
+            return f.read()
+
+    def write_chunk(self, data):
+        '''Store data if it is new. Returns (chunk_id, bytes written)'''
+        chunk_id = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(chunk_id)
+        if exists(path):
+            return chunk_id, 0
+        os.makedirs(dirname(path), exist_ok=True)
+        with atomic_output(path) as f:
+            f.write(data)
+        return chunk_id, len(data)
+
+    def store_file(self, path):
+        '''Split path into chunks and store them. Returns (chunks, written)'''
+        chunks = []
+        written = 0
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+                chunk_id, n = self.write_chunk(data)
+                chunks.append(chunk_id)
+                written += n
+        return chunks, written
+
+    def snapshots(self):
+        '''Snapshot names, oldest first'''
+        return sorted(name[:-len(SNAPSHOT_SUFFIX)]
+                      for name in os.listdir(self.snapshots_dir)
+                      if name.endswith(SNAPSHOT_SUFFIX))
+
+    def snapshot_path(self, name):
+        return join(self.snapshots_dir, name + SNAPSHOT_SUFFIX)
+
+    def load(self, name=None):
+        '''Manifest of snapshot name (default: the latest one)'''
+        if name is None:
+            names = self.snapshots()
+            if not names:
+                return None
+            name = names[-1]
+        with gzip.open(self.snapshot_path(name), 'rt') as f:
+            return json.load(f)
+
+    def snapshot(self, src, name=None):
+        '''Record the files under src as a new snapshot. Returns a stats dict
+
+        Raises FileExistsError rather than replace an existing snapshot.
+        '''
+        start = time.time()
+        name = name or datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        manifest_path = self.snapshot_path(name)
+        if exists(manifest_path):
+            raise FileExistsError('Snapshot {} already exists'.format(name))
+        previous = self.load() or {'files': []}
+        known = {f['path']: f for f in previous['files']}
+        files = []
+        read = written = 0
+        for path, st in walk_files(src):
+            old = known.get(path)
+            if old and old['size'] == st.st_size and \
+               old['mtime'] == st.st_mtime_ns:
+                chunks = old['chunks']
+            else:
+                chunks, n = self.store_file(join(src, path))
+                read += 1
+                written += n
+            files.append(dict(path=path, size=st.st_size,
+                              mtime=st.st_mtime_ns, mode=st.st_mode & 0o7777,
+                              chunks=chunks))
+        manifest = dict(name=name, source=src,
+                        created=datetime.now().isoformat(), files=files)
+        tmppath = join(self.snapshots_dir,
+                       '.{}.{}.new'.format(name, os.getpid()))
+        with atomic_output(tmppath) as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as zf:
+                zf.write(json.dumps(manifest).encode('utf8'))
+        try:
+            # unlike a rename, a link never replaces one made meanwhile
+            os.link(tmppath, manifest_path)
+        finally:
+            os.remove(tmppath)
+        return dict(name=name, files=len(files), read=read, written=written,
+                    seconds=time.time() - start)
+
+    def restore(self, name, dest):
+        '''Recreate snapshot name under dest'''
+        for entry in self.load(name)['files']:
+            path = join(dest, entry['path'])
+            os.makedirs(dirname(path), exist_ok=True)
+            with atomic_output(path) as f:
+                for chunk_id in entry['chunks']:
+                    f.write(self.read_chunk(chunk_id))
+            os.chmod(path, entry['mode'])
+            os.utime(path, ns=(entry['mtime'], entry['mtime']))
+
+    def export_tgz(self, name, outfile):
+        '''Write snapshot name as a .tgz, like tar -czf outfile .'''
+        with atomic_output(outfile) as out:
+            with tarfile.open(fileobj=out, mode='w:gz') as tar:
+                for entry in self.load(name)['files']:
+                    info = tarfile.TarInfo(join('.', entry['path']))
+                    info.size = entry['size']
+                    info.mtime = entry['mtime'] // 10 ** 9
+                    info.mode = entry['mode']
+                    tar.addfile(info, ChunkReader(self, entry['chunks']))
+
+    def prune(self, keep):
+        '''Keep the latest keep snapshots, delete blobs nobody refers to'''
+        names = self.snapshots()
+        for name in names[:-keep] if keep else names:
+            os.remove(self.snapshot_path(name))
+        live = set()
+        for name in self.snapshots():
+            for entry in self.load(name)['files']:
+                live.update(entry['chunks'])
+        freed = 0
+        for path, st in list(walk_files(self.objects_dir)):
+            if path.replace(os.sep, '') not in live:
+                os.remove(join(self.objects_dir, path))
+                freed += st.st_size
+        return freed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Deduplicated media backups')
+    parser.add_argument('store', help='store directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser('snapshot', help='snapshot a directory')
+    p.add_argument('src')
+    p.add_argument('--name', help='snapshot name (default: timestamp)')
+    subparsers.add_parser('list', help='list snapshots')
+    p = subparsers.add_parser('restore', help='restore a snapshot')
+    p.add_argument('name')
+    p.add_argument('dest')
+    p = subparsers.add_parser('export', help='export a snapshot to a .tgz')
+    p.add_argument('name')
+    p.add_argument('outfile')
+    p = subparsers.add_parser('prune', help='drop old snapshots and blobs')
+    p.add_argument('keep', type=int)
+    args = parser.parse_args()
+
+    store = MediaStore(args.store)
+    if args.command == 'snapshot':
+        stats = store.snapshot(args.src, args.name)
+        print('{name}: {files} files, {read} read, {0} new in {seconds:.1f}s'
+              .format(human_bytes(stats['written']), **stats))
+    elif args.command == 'list':
+        for name in store.snapshots():
+            print(name)
+    elif args.command == 'restore':
+        store.restore(args.name, args.dest)
+    elif args.command == 'export':
+        store.export_tgz(args.name, args.outfile)
+    elif args.command == 'prune':
+        print('freed {}'.format(human_bytes(store.prune(args.keep))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+'''Local stand-in for the SendGrid and Mandrill APIs, and a benchmark
+
+The server implements the parts of the APIs send_mail.py uses:
+
+    POST /v3/mail/send                 SendGrid v3, 202 on success
+    POST /api/1.0/messages/send.json   Mandrill, 200 with per-recipient status
+    GET  /stats                        request counts, as JSON
+
+and can add latency, random 500s, and 429s above a request rate.
+
+    python mockmail.py serve --port 8025 --latency 0.05 --error-rate 0.01
+    python mockmail.py bench --concurrency 1,4,16 --messages 500
+
+bench starts a server in-process unless --url points at one, configures
+django settings for send_mail (SENDGRID_API_URL, MANDRILL_API_URL, ...)
+and reports messages/sec and p50/p99 latency for each send function at
+each concurrency level. Run the server separately (serve) when the
+numbers should not include the server's own CPU time.
+'''
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+
+SENDGRID_PATH = '/v3/mail/send'
+MANDRILL_PATH = '/api/1.0/messages/send.json'
+SENDGRID_MAX_PERSONALIZATIONS = 1000
+BENCH_FUNCTIONS = ('sendgrid_send', 'sendgrid_send_template', 'mandrill_send')
+
+
+class MockOptions(object):
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate=None,
+                 key=None):
+        '''latency, jitter: seconds added to every response (uniform jitter)
+        error_rate: fraction of requests answered with a 500
+        rate: requests per second allowed before answering 429
+        key: if set, the API key requests must use
+        '''
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate = rate
+        self.key = key
+
+
+class Throttle(object):
+    '''Token bucket: allow() is False once rate requests/sec is exceeded'''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class MockMailHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'          # keep-alive, like the real APIs
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self.respond(404, {'error': 'not found'})
+        with self.server.lock:
+            stats = dict(self.server.stats)
+        self.respond(200, stats)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        options = self.server.options
+        delay = options.latency + random.uniform(0, options.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if self.path == SENDGRID_PATH:
+            handler = self.sendgrid
+        elif self.path == MANDRILL_PATH:
+            handler = self.mandrill
+        else:
+            return self.respond(404, {'error': 'not found'})
+
+        if self.server.throttle and not self.server.throttle.allow():
+            status, payload, messages = 429, {'errors': [
+                {'message': 'too many requests'}]}, 0
+        elif random.random() < options.error_rate:
+            status, payload, messages = 500, {'errors': [
+                {'message': 'mock server error'}]}, 0
+        else:
+            try:
+                data = json.loads(body.decode('utf8'))
+            except ValueError:
+                data = None
+            status, payload, messages = handler(data)
+
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+            self.server.stats['messages'] += messages
+            self.server.stats['status_{}'.format(status)] += 1
+        self.respond(status, payload)
+
+    def sendgrid(self, data):
+        '''(status, payload, messages accepted) for a v3 mail/send body'''
+        key = self.server.options.key
+        if key and self.headers.get('Authorization') != 'Bearer ' + key:
+            return 401, {'errors': [{'message': 'bad api key'}]}, 0
+        if not isinstance(data, dict):
+            return 400, {'errors': [{'message': 'invalid JSON'}]}, 0
+        personalizations = data.get('personalizations') or []
+        errors = []
+        if not 1 <= len(personalizations) <= SENDGRID_MAX_PERSONALIZATIONS:
+            errors.append('personalizations must have 1 to {} items'.format(
+                SENDGRID_MAX_PERSONALIZATIONS))
+        if not (data.get('from') or {}).get('email'):
+            errors.append('from.email is required')
+        if not data.get('content') and not data.get('template_id'):
+            errors.append('content or template_id is required')
+        if any(not p.get('to') for p in personalizations):
+            errors.append('every personalization needs a to')
+        if errors:
+            return 400, {'errors': [{'message': e} for e in errors]}, 0
+        return 202, None, sum(len(p['to']) + len(p.get('cc', [])) +
+                              len(p.get('bcc', []))
+                              for p in personalizations)
+
+    def mandrill(self, data):
+        key = self.server.options.key
+        if not isinstance(data, dict):
+            return 500, {'status': 'error', 'name': 'ValidationError',
+                         'message': 'invalid JSON'}, 0
+        if key and data.get('key') != key:
+            return 500, {'status': 'error', 'name': 'Invalid_Key',
+                         'message': 'Invalid API key'}, 0
+        recipients = (data.get('message') or {}).get('to') or []
+        return 200, [{'email': r.get('email'), 'status': 'sent',
+                      '_id': uuid.uuid4().hex, 'reject_reason': None}
+                     for r in recipients], len(recipients)
+
+    def respond(self, status, payload):
+        body = b'' if payload is None else json.dumps(payload).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(host='127.0.0.1', port=0, options=None):
+    '''A MockMailHandler server; port 0 picks a free port'''
+    server = ThreadingHTTPServer((host, port), MockMailHandler)
+    server.daemon_threads = True
+    server.options = options or MockOptions()
+    server.throttle = Throttle(server.options.rate) \
+        if server.options.rate else None
+    server.stats = Counter()
+    server.lock = threading.Lock()
+    return server
+
+
+def start_server(**kwargs):
+    '''make_server in a background thread. Returns (server, base url)'''
+    server = make_server(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    return server, 'http://{}:{}'.format(host, port)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100.0))
+    return sorted_values[index]
+
+
+def configure_django(url, pool_size, key='mock'):
+    '''Minimal settings so send_mail can be imported outside a project'''
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(
+            SENDGRID_KEY=key,
+            MANDRILL_KEY=key,
+            DEFAULT_REGISTRATIONS_FROM_EMAIL='bench@example.com',
+            SENDGRID_API_URL=url + SENDGRID_PATH,
+            MANDRILL_API_URL=url + MANDRILL_PATH,
+            MAIL_HTTP_POOL_SIZE=pool_size,
+        )
+
+
+def _import_send_mail():
+    try:
+        from . import send_mail
+    except ImportError:
+        # run as a script
+        import send_mail
+    return send_mail
+
+
+def _bench_call(send_mail, name, i):
+    to = 'user{}@example.com'.format(i)
+    if name == 'sendgrid_send':
+        send_mail.sendgrid_send('Benchmark', 'Hello', 'bench@example.com',
+                                [to])
+    elif name == 'sendgrid_send_template':
+        send_mail.sendgrid_send_template(
+            'd-benchmark', [[to, {'username': 'user{}'.format(i)}]],
+            {'company_name': 'Benchmark'})
+    else:
+        # mandrill_send raises on the status, not on rejected recipients
+        res = send_mail.mandrill_send('Benchmark', 'Hello',
+                                      'bench@example.com', [to])
+        for recipient in res.json():
+            if recipient.get('status') in ('rejected', 'invalid'):
+                raise Exception('mandrill {}: {}'.format(
+                    recipient['status'], recipient.get('reject_reason')))
+
+
+def bench(send_mail, name, concurrency, messages):
+    '''Send messages one-recipient mails using concurrency threads
+
+    Returns a dict with msgs_per_sec, p50, p99 (seconds) and errors.
+    '''
+    def timed(i):
+        start = time.perf_counter()
+        try:
+            _bench_call(send_mail, name, i)
+            error = None
+        except Exception as e:
+            error = type(e).__name__
+        return time.perf_counter() - start, error
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(timed, range(messages)))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for latency, error in results)
+    return dict(function=name, concurrency=concurrency, messages=messages,
+                errors=sum(1 for latency, error in results if error),
+                msgs_per_sec=messages / elapsed if elapsed else 0.0,
+                p50=percentile(latencies, 50), p99=percentile(latencies, 99))
+
+
+def run_benchmarks(url, functions, concurrencies, messages):
+    configure_django(url, max(concurrencies))
+    send_mail = _import_send_mail()
+    results = []
+    for name in functions:
+        if name == 'sendgrid_send_template' and send_mail.sendgrid is None:
+            sys.stderr.write('Skipping {}: sendgrid is not installed\n'
+                             .format(name))
+            continue
+        for concurrency in concurrencies:
+            try:
+                _bench_call(send_mail, name, 0)     # warm up the connection
+            except Exception:
+                pass          # --error-rate/--rate apply to it too
+            results.append(bench(send_mail, name, concurrency, messages))
+    return results
+
+
+def print_results(results):
+    print('{:<24} {:>5} {:>7} {:>6} {:>9} {:>9} {:>9}'.format(
+        'function', 'conc', 'msgs', 'errors', 'msgs/s', 'p50 ms', 'p99 ms'))
+    for r in results:
+        print('{function:<24} {concurrency:>5} {messages:>7} {errors:>6} '
+              '{msgs_per_sec:>9.1f} {p50_ms:>9.1f} {p99_ms:>9.1f}'.format(
+                  p50_ms=r['p50'] * 1000, p99_ms=r['p99'] * 1000, **r))
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='up to this many more seconds, at random')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with a 500')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='requests/sec allowed before answering 429')
+
+
+def server_options(args, key=None):
+    return MockOptions(latency=args.latency, jitter=args.jitter,
+                       error_rate=args.error_rate, rate=args.rate, key=key)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Mock SendGrid/Mandrill server and send_mail benchmark')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    serve = subparsers.add_parser('serve', help='run the mock server')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8025)
+    serve.add_argument('--key', default=None,
+                       help='reject requests not using this API key')
+    add_server_arguments(serve)
+
+    bench_parser = subparsers.add_parser('bench', help='benchmark send_mail')
+    bench_parser.add_argument('--url', default=None,
+                              help='use this mock server, not an in-process one')
+    bench_parser.add_argument('--concurrency', default='1,4,16',
+                              help='comma separated thread counts')
+    bench_parser.add_argument('--messages', type=int, default=200,
+                              help='messages per function and concurrency')
+    bench_parser.add_argument('--functions', default=','.join(BENCH_FUNCTIONS))
+    bench_parser.add_argument('--json', action='store_true',
+                              help='print results as JSON')
+    add_server_arguments(bench_parser)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = make_server(args.host, args.port,
+                             server_options(args, args.key))
+        print('Mock mail server on http://{}:{}'.format(
+            *server.server_address[:2]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    url = args.url
+    if url is None:
+        server, url = start_server(options=server_options(args))
+    results = run_benchmarks(
+        url.rstrip('/'), args.functions.split(','),
+        [int(c) for c in args.concurrency.split(',')], args.messages)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
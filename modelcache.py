@@ -0,0 +1,311 @@
+'''model_cache: cache the result of an expensive model method in a field
+
+    class Company(models.Model):
+        score_cache = models.FloatField(null=True)
+
+        @model_cache('score_cache')
+        def score(self):
+            return expensive()
+
+company.score() computes and stores the value the first time, and
+returns the stored value after that. company.score(force=True)
+recomputes it.
+
+When several processes find the value missing at the same time, only
+one computes it: the others wait (up to `wait` seconds) for it to show
+up in the database. The lock is taken with cache.add on the django
+cache, so it is only shared between processes if that cache is.
+
+Only the cached field (and timestamp_field, if any) is written, with a
+conditional UPDATE, never the whole row.
+
+depends_on declares what the value is computed from:
+
+        @model_cache('score_cache', depends_on=[
+            ('myapp.Submission', 'submission'),
+            ('myapp.Test', lambda test: Company.objects.filter(tests=test),
+             ['max_score']),
+        ])
+
+Each entry is (model, lookup[, fields]). lookup is a query path from
+the cached model to model, or a callable(instance) returning a queryset
+of cached objects. When an instance of model is saved (and fields, if
+given, were among those saved) or deleted, the affected cached values
+are set to NULL with a single UPDATE. They are then recomputed lazily,
+or in bulk by precompute / manage.py precompute_cache. The signals are
+connected by dutils.apps when django starts.
+
+Django is imported lazily, so `import dutils` works without it.
+'''
+from functools import wraps
+import time
+
+LOCK_TIMEOUT = 60             # seconds a computation may hold the lock
+WAIT = 10                     # seconds to wait for another process's result
+POLL_INTERVAL = 0.1
+
+
+def _is_stale(obj, value, ttl, timestamp_field, is_stale):
+    if is_stale is not None:
+        return is_stale(obj, value)
+    if value is None:
+        return True
+    if ttl is not None:
+        from django.utils import timezone
+        stamp = getattr(obj, timestamp_field)
+        return stamp is None or (timezone.now() - stamp).total_seconds() > ttl
+    return False
+
+
+def _lock_key(obj, field):
+    return 'model_cache:{}:{}:{}'.format(obj._meta.label_lower, obj.pk, field)
+
+
+def _write(obj, field, timestamp_field, old_value, old_stamp, force):
+    '''UPDATE only the cached fields, unless someone else already did'''
+    values = {field: getattr(obj, field)}
+    qs = type(obj)._base_manager.filter(pk=obj.pk)
+    if timestamp_field:
+        values[timestamp_field] = getattr(obj, timestamp_field)
+        if not force:
+            qs = qs.filter(**{timestamp_field: old_stamp})
+    elif not force and old_value is None:
+        qs = qs.filter(**{field + '__isnull': True})
+    return qs.update(**values)
+
+
+def model_cache(field, ttl=None, timestamp_field=None, is_stale=None,
+                lock_timeout=LOCK_TIMEOUT, wait=WAIT, depends_on=()):
+    '''Cache the method's result in field
+
+    By default the value is recomputed only when field is None.
+    ttl: recompute when timestamp_field is older than ttl seconds
+    timestamp_field: DateTimeField set whenever the value is computed
+    is_stale: callable(obj, value) -> bool, replaces the rules above
+    lock_timeout, wait: see the module docstring
+    depends_on: see the module docstring
+
+    The wrapped method takes save=True (write the value to the database)
+    and force=False (recompute even if the value is fresh).
+    '''
+    if ttl is not None and not timestamp_field:
+        raise ValueError('model_cache ttl needs a timestamp_field')
+
+    def decorator(f):
+        def stale(obj):
+            return _is_stale(obj, getattr(obj, field, None),
+                             ttl, timestamp_field, is_stale)
+
+        def compute(obj):
+            '''Set the new value, return the old (value, timestamp)'''
+            old = (getattr(obj, field, None),
+                   getattr(obj, timestamp_field) if timestamp_field else None)
+            setattr(obj, field, f(obj))
+            if timestamp_field:
+                from django.utils import timezone
+                setattr(obj, timestamp_field, timezone.now())
+            return old
+
+        def refresh(obj):
+            obj.refresh_from_db(fields=[field] + (
+                [timestamp_field] if timestamp_field else []))
+
+        @wraps(f)
+        def wrapper(self, save=True, force=False):
+            if not force and not stale(self):
+                return getattr(self, field)
+            if not save or self.pk is None:
+                compute(self)
+                if save:
+                    self.save()
+                return getattr(self, field)
+
+            from django.core.cache import cache
+            key = None if force else _lock_key(self, field)
+            if key and not cache.add(key, 1, lock_timeout):
+                # someone else is computing it: wait for their result
+                deadline = time.monotonic() + wait
+                while time.monotonic() < deadline:
+                    time.sleep(POLL_INTERVAL)
+                    refresh(self)
+                    if not stale(self):
+                        return getattr(self, field)
+                key = None          # gave up waiting, compute it ourselves
+            try:
+                old_value, old_stamp = compute(self)
+                _write(self, field, timestamp_field, old_value, old_stamp,
+                       force)
+            finally:
+                if key:
+                    cache.delete(key)
+            return getattr(self, field)
+
+        wrapper.cache_field = field
+        wrapper.timestamp_field = timestamp_field
+        wrapper.compute = f
+        wrapper.depends_on = depends_on
+        return wrapper
+    return decorator
+
+
+def _compute_chunk(model_label, method_name, pks):
+    '''[(pk, value, timestamp)] for pks. Runs in a worker thread or process'''
+    from django.apps import apps
+    from django.db import connection
+    from django.utils import timezone
+    model = apps.get_model(model_label)
+    compute = getattr(model, method_name).compute
+    try:
+        objs = model._base_manager.in_bulk(pks)
+        return [(pk, compute(obj), timezone.now())
+                for pk, obj in objs.items()]
+    finally:
+        connection.close()           # thread/process local connection
+
+
+def _compute_chunk_star(args):
+    return _compute_chunk(*args)
+
+
+def _close_connections():
+    from django.db import connections
+    connections.close_all()
+
+
+def _print_progress(done, total):
+    import sys
+    sys.stderr.write('precompute: {}/{}\n'.format(done, total))
+
+
+def precompute(queryset, method, chunk_size=500, workers=1,
+               processes=False, force=False, progress=_print_progress):
+    '''Fill a model_cache field for every object in queryset
+
+    method: the decorated method (Model.score) or its name ('score')
+    Values are computed chunk_size objects at a time, on workers threads
+    (or forked processes if processes=True), and written back with one
+    bulk_update per chunk. Without force, only objects whose field is
+    NULL are computed.
+    progress(done, total) is called after every chunk.
+    Returns the number of objects computed.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    import multiprocessing
+
+    model = queryset.model
+    name = method if isinstance(method, str) else method.__name__
+    wrapper = getattr(model, name)
+    field, timestamp_field = wrapper.cache_field, wrapper.timestamp_field
+    fields = [field] + ([timestamp_field] if timestamp_field else [])
+    if not force:
+        queryset = queryset.filter(**{field + '__isnull': True})
+    pks = list(queryset.values_list('pk', flat=True))
+    chunks = [pks[i:i + chunk_size] for i in range(0, len(pks), chunk_size)]
+    label = model._meta.label
+
+    if processes:
+        _close_connections()       # never share a connection with children
+        pool = multiprocessing.get_context('fork').Pool(
+            workers, initializer=_close_connections)
+        results = pool.imap_unordered(_compute_chunk_star,
+                                      [(label, name, c) for c in chunks])
+    else:
+        pool = ThreadPoolExecutor(workers)
+        results = pool.map(lambda c: _compute_chunk(label, name, c), chunks)
+
+    done = 0
+    try:
+        for values in results:
+            objs = []
+            for pk, value, stamp in values:
+                obj = model(pk=pk)
+                setattr(obj, field, value)
+                if timestamp_field:
+                    setattr(obj, timestamp_field, stamp)
+                objs.append(obj)
+            model._base_manager.bulk_update(objs, fields)
+            done += len(objs)
+            if progress:
+                progress(done, len(pks))
+    finally:
+        if processes:
+            pool.close()
+            pool.join()
+        else:
+            pool.shutdown()
+    return done
+
+
+def mark_stale(queryset, *methods):
+    '''Set the model_cache fields of methods to NULL, in one UPDATE'''
+    values = {}
+    for method in methods:
+        if isinstance(method, str):
+            method = getattr(queryset.model, method)
+        values[method.cache_field] = None
+        if method.timestamp_field:
+            values[method.timestamp_field] = None
+    return queryset.update(**values)
+
+
+class _Dependency(object):
+    def __init__(self, model, method, lookup, fields):
+        self.model = model
+        self.method = method
+        self.lookup = lookup
+        self.fields = set(fields) if fields else None
+
+    def targets(self, instance):
+        if callable(self.lookup):
+            return self.lookup(instance)
+        return self.model._base_manager.filter(
+            **{self.lookup: instance}).distinct()
+
+    def invalidate(self, instance, update_fields=None):
+        if self.fields and update_fields is not None \
+           and not self.fields & set(update_fields):
+            return 0
+        # pks first: MySQL cannot UPDATE a table it selects from
+        pks = list(self.targets(instance).values_list('pk', flat=True))
+        if not pks:
+            return 0
+        return mark_stale(self.model._base_manager.filter(pk__in=pks),
+                          self.method)
+
+
+_dependencies = {}             # dependency model -> [_Dependency]
+
+
+def _on_save(sender, instance, update_fields=None, raw=False, **kwargs):
+    if raw:
+        return                 # loaddata
+    for dependency in _dependencies.get(sender, []):
+        dependency.invalidate(instance, update_fields)
+
+
+def _on_delete(sender, instance, **kwargs):
+    # pre_delete, while lookups through instance still find its targets
+    for dependency in _dependencies.get(sender, []):
+        dependency.invalidate(instance)
+
+
+def connect_dependencies():
+    '''Connect signals for the depends_on of every model_cache method'''
+    from django.apps import apps
+    from django.db.models.signals import post_save, pre_delete
+    _dependencies.clear()
+    for model in apps.get_models():
+        for name in dir(model):
+            method = getattr(model, name, None)
+            for dependency in getattr(method, 'depends_on', None) or ():
+                sender, lookup = dependency[:2]
+                fields = dependency[2] if len(dependency) > 2 else None
+                if isinstance(sender, str):
+                    sender = apps.get_model(sender)
+                _dependencies.setdefault(sender, []).append(
+                    _Dependency(model, method, lookup, fields))
+    for sender in _dependencies:
+        post_save.connect(_on_save, sender=sender,
+                          dispatch_uid='model_cache_save')
+        pre_delete.connect(_on_delete, sender=sender,
+                           dispatch_uid='model_cache_delete')
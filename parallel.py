@@ -0,0 +1,122 @@
+'''Run the same task on several hosts at once
+
+Each host's output is buffered and printed in one piece, every line
+prefixed with the host name, when that host finishes. At the end a
+summary table shows time taken and success/failure per host.
+'''
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout, redirect_stderr
+import io
+import multiprocessing
+import sys
+import threading
+import time
+import traceback
+
+DEFAULT_WORKERS = 8
+
+_print_lock = threading.Lock()
+
+
+class HostResult(object):
+    def __init__(self, host, ok, seconds, output, result=None, error=None):
+        self.host = host
+        self.ok = ok
+        self.seconds = seconds
+        self.output = output
+        self.result = result
+        self.error = error
+
+
+def print_prefixed(host, output, stream=None):
+    stream = stream or sys.stdout
+    with _print_lock:
+        for line in output.splitlines():
+            stream.write('[{}] {}\n'.format(host, line))
+        stream.flush()
+
+
+def print_summary(results, stream=None):
+    stream = stream or sys.stdout
+    width = max([len(str(r.host)) for r in results] + [4])
+    stream.write('\n{:<{w}}  {:>8}  {}\n'.format('host', 'seconds', 'status',
+                                                   w=width))
+    for r in results:
+        stream.write('{:<{w}}  {:>8.1f}  {}\n'.format(
+            str(r.host), r.seconds, 'ok' if r.ok else 'FAILED: {}'.format(
+                r.error), w=width))
+    stream.write('{} ok, {} failed\n'.format(
+        sum(r.ok for r in results), sum(not r.ok for r in results)))
+
+
+def _call(host, func, args, kwargs, buf):
+    start = time.time()
+    try:
+        result = func(*args, **kwargs)
+        ok, error = True, None
+    except BaseException as e:
+        # SystemExit too: fabric's abort() calls sys.exit
+        buf.write(traceback.format_exc())
+        result, ok, error = None, False, repr(e)
+    return HostResult(host, ok, time.time() - start, buf.getvalue(),
+                      result=result, error=error)
+
+
+def run_threads(hosts, func, workers=DEFAULT_WORKERS, summary=True):
+    '''Call func(host, out) for every host on a thread pool
+
+    out is a buffer the task should send its output to (for invoke,
+    pass it as out_stream/err_stream). Returns a list of HostResult.
+    '''
+    def one(host):
+        buf = io.StringIO()
+        result = _call(host, func, (host, buf), {}, buf)
+        print_prefixed(host, result.output)
+        return result
+
+    with ThreadPoolExecutor(min(workers, len(hosts)) or 1) as pool:
+        results = list(pool.map(one, hosts))
+    if summary:
+        print_summary(results)
+    return results
+
+
+# Jobs for run_processes. Handed to the workers by fork rather than by
+# pickling, so closures and decorated tasks work.
+_jobs = []
+
+
+def _process_worker(i):
+    host, func, args, kwargs = _jobs[i]
+    buf = io.StringIO()
+    with redirect_stdout(buf), redirect_stderr(buf):
+        result = _call(host, func, args, kwargs, buf)
+    result.result = None     # may not be picklable
+    return result
+
+
+def run_processes(jobs, workers=DEFAULT_WORKERS, initializer=None,
+                  summary=True):
+    '''Run func(*args, **kwargs) for every (host, func, args, kwargs)
+
+    Each job runs in a forked worker process with stdout and stderr
+    captured, for code that keeps its state in globals (fabric 1's env).
+    Returns a list of HostResult in the order of jobs.
+    '''
+    _jobs[:] = jobs
+    results = [None] * len(jobs)
+    ctx = multiprocessing.get_context('fork')
+    try:
+        with ctx.Pool(min(workers, len(jobs)) or 1,
+                      initializer=initializer) as pool:
+            for i, result in enumerate(pool.imap(_process_worker,
+                                                 range(len(jobs)))):
+                results[i] = result
+                print_prefixed(result.host, result.output)
+    finally:
+        _jobs[:] = []
+    if summary:
+        print_summary(results)
+    return results
@@ -9,24 +9,428 @@ Drop the database and recreate it so db is clean.
 from being sent.
 '''
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
+import hashlib
+import json
 import os
-from os.path import exists, expanduser, abspath
+from os.path import exists, expanduser, abspath, getsize
+import signal
 import sys
 import subprocess
-import MySQLdb as mysql
+import tarfile
+import time
 from logging.config import fileConfig
-from django.conf import settings
-from django.core.management import execute_from_command_line
+
+# MySQLdb and django are imported when first needed: --help, --rollback
+# and argument errors don't pay for them, and django is set up only once
+
+from dumputils import (atomic_output, cpu_count, iter_file, iter_gunzip,
+                       is_sharded_dump, mysql_auth_args, read_manifest,
+                       LoadProgress)
+from tablefilter import TableRules, filter_sql
 
 import logging
 logger = logging.getLogger(__name__)
 
+# --fast: session settings for every loader connection. autocommit=0
+# batches inserts into large transactions, so mysql_load ends with COMMIT
+# (bulk_insert_buffer_size is left out: it only helps MyISAM)
+BULK_SESSION = dict(unique_checks=0,
+                    foreign_key_checks=0,
+                    autocommit=0,
+                    sort_buffer_size=64 << 20)
+# --fast: server-wide settings for the duration of the load. Restored by
+# bulk_load_settings however the load ends: errors, ^C, SIGTERM, SIGHUP
+BULK_GLOBAL = dict(innodb_flush_log_at_trx_commit=0,
+                   sync_binlog=0,
+                   max_allowed_packet=1 << 30)
+
+
+class PhaseTimer(object):
+    '''Time the phases of a restore, for a breakdown at the end'''
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def __call__(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - start))
+            logger.debug('{} took {:.1f}s'.format(name, self.phases[-1][1]))
+
+    def summary(self):
+        total = sum(seconds for name, seconds in self.phases)
+        return '\n'.join(['Timing:'] + [
+            '  {:<24} {:8.1f}s {:5.1f}%'.format(
+                name, seconds, 100 * seconds / (total or 1))
+            for name, seconds in self.phases] + [
+            '  {:<24} {:8.1f}s'.format('total', total)])
+
+
+phase = PhaseTimer()
+
+
+def session_prelude(cursor, log_bin):
+    '''SQL to run at the start of every loader session
+
+    Each setting is tried on cursor first, and those refused are left
+    out (sql_log_bin needs SUPER or BINLOG ADMIN): the mariadb client
+    stops the whole load at the first error.
+    '''
+    from MySQLdb import MySQLError
+    values = dict(BULK_SESSION)
+    if log_bin:
+        values['sql_log_bin'] = 0       # don't binlog the _tmp database
+    statements = []
+    for name, value in values.items():
+        statement = 'SET SESSION {}={};'.format(name, value)
+        try:
+            cursor.execute(statement)
+        except MySQLError as e:
+            logger.warning('Could not set {}={}: {}'.format(name, value, e))
+            continue
+        statements.append(statement + '\n')
+    return ''.join(statements).encode('utf8')
+
+
+def _global_settings(connect, values):
+    '''SET GLOBAL values. Returns the old values of those that were set'''
+    from MySQLdb import MySQLError
+    conn = connect()
+    cursor = conn.cursor()
+    old_values = {}
+    try:
+        for name, value in values.items():
+            cursor.execute('SELECT @@GLOBAL.{}'.format(name))
+            old = cursor.fetchone()[0]
+            try:
+                cursor.execute('SET GLOBAL {}=%s'.format(name), [value])
+            except MySQLError as e:
+                logger.warning('Could not set {}={}: {}'.format(
+                    name, value, e))
+                continue
+            old_values[name] = old
+    finally:
+        cursor.close()
+        conn.close()
+    return old_values
+
+
+@contextmanager
+def bulk_load_settings(connect):
+    '''Apply BULK_GLOBAL, and put the old values back however we leave
+
+    SIGTERM and SIGHUP (a dropped ssh session) are turned into SystemExit
+    meanwhile, so that the finally runs for them too. The old values are
+    restored on a new connection, since the load can take longer than
+    the server keeps an idle one open.
+    '''
+    def terminate(signum, frame):
+        raise SystemExit(128 + signum)
+
+    saved = _global_settings(connect, BULK_GLOBAL)
+    logger.debug('Bulk load settings: {}'.format(saved))
+    handlers = {signum: signal.signal(signum, terminate)
+                for signum in (signal.SIGTERM, signal.SIGHUP)}
+    try:
+        yield
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+        _global_settings(connect, saved)
+
+
+def mysql_load(db, dbname, chunks, prelude=b''):
+    '''Feed chunks of SQL into a mariadb client connected to dbname
+
+    prelude: SQL sent first, see session_prelude. If given, the load is
+    committed at the end.
+    '''
+    cmd = ['mariadb'] + mysql_auth_args(db) + [dbname]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        proc.stdin.write(prelude)
+        for chunk in chunks:
+            proc.stdin.write(chunk)
+        if prelude:
+            proc.stdin.write(b'\nCOMMIT;\n')
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass                          # mariadb died, reported below
+        if proc.wait() != 0:
+            raise Exception('mariadb failed: {}'.format(proc.returncode))
+
+
+def load_member(db, dbname, dbfile, member, entry, prelude=b'',
+                rules=None):
+    '''Load one gzipped member of a sharded dump, verifying its checksum
+
+    Every worker opens the tar on its own and seeks to its member, so
+    members are read and loaded concurrently. Returns the member's
+    LoadProgress record.
+    '''
+    sha256 = hashlib.sha256()
+    progress = LoadProgress(member.size, log=logger.debug)
+
+    def chunks():
+        with open(dbfile, 'rb') as f:
+            f.seek(member.offset_data)
+            for data in iter_file(f, member.size):
+                sha256.update(data)
+                yield data
+
+    mysql_load(db, dbname, progress.sql(filter_sql(
+        iter_gunzip(progress.compressed(chunks())), rules)), prelude)
+    if sha256.hexdigest() != entry['sha256']:
+        raise Exception('Checksum mismatch for {}'.format(entry['file']))
+    record = progress.record()
+    logger.debug('Loaded {} (~{} rows) in {}s'.format(
+        entry['file'], entry.get('rows', '?'), record['seconds']))
+    return record
+
+
+def load_sharded(db, dbname, dbfile, jobs, prelude=b'', rules=None):
+    '''Restore a dumpdb --sharded file: schema, tables in parallel, indexes
+
+    Returns a record like LoadProgress.record(), totalled over the
+    members. Table times overlap, so they add up to more than seconds.
+    '''
+    start = time.time()
+    with tarfile.open(dbfile) as tar:
+        manifest = read_manifest(tar)
+        members = {m.name: m for m in tar.getmembers()}
+
+    def load(entry):
+        return load_member(db, dbname, dbfile, members[entry['file']], entry,
+                           prelude, rules)
+
+    with phase('schema'):
+        records = [load(manifest['schema'])]
+    # biggest tables first, so one of them does not start last
+    tables = sorted((t for t in manifest['tables']
+                     if not rules or rules.action(t['name']) not in
+                     ('exclude', 'schema')),
+                    key=lambda t: -t['bytes'])
+    logger.info('Loading {} tables with {} jobs'.format(len(tables), jobs))
+    with phase('data'), ThreadPoolExecutor(jobs) as pool:
+        records += pool.map(load, tables)
+    logger.info('Loaded data, now adding indexes and constraints')
+    with phase('indexes'):
+        records.append(load(manifest['post']))
+
+    tables = {}
+    for record in records:
+        for table in record['tables']:
+            entry = tables.setdefault(table['name'], [0, 0.0])
+            entry[0] += table['bytes']
+            entry[1] += table['seconds']
+    return dict(
+        seconds=round(time.time() - start, 3),
+        compressed_bytes=sum(r['compressed_bytes'] for r in records),
+        sql_bytes=sum(r['sql_bytes'] for r in records),
+        statements=sum(r['statements'] for r in records),
+        tables=[dict(name=name, bytes=size, seconds=round(seconds, 3))
+                for name, (size, seconds) in sorted(
+                    tables.items(), key=lambda t: -t[1][1])])
+
+
+def load_stream(db, dbname, src, tee=None, prelude=b'', total_bytes=None,
+                rules=None):
+    '''Load a gzipped dump read from src as it arrives, logging progress
+
+    src: a file, e.g. stdin, or an open .sql.gz
+    tee: also save the compressed stream to this file. It only appears
+    once the whole stream has been read and loaded.
+    total_bytes: size of src if known, for the ETA
+    rules: TableRules to filter the SQL with
+    Returns the LoadProgress record.
+    '''
+    progress = LoadProgress(total_bytes, log=logger.info)
+
+    def chunks(out):
+        for data in progress.compressed(iter_file(src)):
+            if out:
+                out.write(data)
+            yield data
+
+    if tee:
+        with atomic_output(expanduser(tee)) as out:
+            mysql_load(db, dbname, progress.sql(filter_sql(
+                iter_gunzip(chunks(out)), rules)), prelude)
+    else:
+        mysql_load(db, dbname, progress.sql(filter_sql(
+            iter_gunzip(chunks(None)), rules)), prelude)
+    progress.log_progress()
+    return progress.record()
+
+
+def load_file(db, dbname, dbfile, prelude=b'', rules=None):
+    '''Load a .sql.gz. Returns the LoadProgress record
+
+    gunzip decompresses on a core of its own, and only the SQL is
+    counted and relayed to mariadb here.
+    '''
+    progress = LoadProgress(getsize(dbfile), log=logger.info)
+    with open(dbfile, 'rb') as f:
+        gunzip = subprocess.Popen(['gunzip', '-c'], stdin=f,
+                                  stdout=subprocess.PIPE)
+
+        def chunks():
+            for data in iter_file(gunzip.stdout):
+                # gunzip shares f's file offset: that is how far it has read
+                progress.compressed_bytes = os.lseek(f.fileno(), 0,
+                                                     os.SEEK_CUR)
+                yield data
 
-def replace_db(dbfile):
-    if not exists(expanduser(dbfile)):
+        try:
+            mysql_load(db, dbname, progress.sql(filter_sql(chunks(), rules)),
+                       prelude)
+        finally:
+            gunzip.stdout.close()     # a gunzip still writing gets SIGPIPE
+            gunzip.wait()
+    if gunzip.returncode != 0:
+        raise Exception('gunzip failed: {}'.format(gunzip.returncode))
+    progress.log_progress()
+    return progress.record()
+
+
+def mysql_connect(db):
+    '''Server connection (no database selected) as db's user'''
+    import MySQLdb
+    return MySQLdb.connect(user=db['USER'], passwd=db['PASSWORD'])
+
+
+def _base_tables(cursor, dbname):
+    cursor.execute("SELECT TABLE_NAME FROM information_schema.TABLES "
+                   "WHERE TABLE_SCHEMA=%s AND TABLE_TYPE='BASE TABLE'",
+                   [dbname])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _has_views_or_triggers(cursor, dbnames):
+    '''RENAME TABLE cannot move these between databases'''
+    placeholders = ', '.join(['%s'] * len(dbnames))
+    cursor.execute("SELECT COUNT(*) FROM information_schema.TABLES "
+                   "WHERE TABLE_TYPE='VIEW' AND TABLE_SCHEMA IN ({})"
+                   .format(placeholders), dbnames)
+    views = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM information_schema.TRIGGERS "
+                   "WHERE TRIGGER_SCHEMA IN ({})".format(placeholders),
+                   dbnames)
+    return views or cursor.fetchone()[0]
+
+
+def _rename_tables(cursor, moves):
+    '''One RENAME TABLE for [(from_db, to_db, tables)], atomic as a whole'''
+    renames = ['`{0}`.`{2}` TO `{1}`.`{2}`'.format(from_db, to_db, table)
+               for from_db, to_db, tables in moves for table in tables]
+    if renames:
+        cursor.execute('RENAME TABLE ' + ', '.join(renames))
+    return len(renames)
+
+
+def _recreate_database(cursor, dbname):
+    cursor.execute('DROP DATABASE IF EXISTS `{}`'.format(dbname))
+    cursor.execute('CREATE DATABASE `{}` character set utf8 '
+                   'collate utf8_general_ci'.format(dbname))
+
+
+def swap_in(connect, new, live, old):
+    '''Make new's tables live, keeping live's current tables in old
+
+    Every table moves in a single RENAME TABLE, so the app sees either
+    the old database or the new one, never a mix. The previous old is
+    dropped; new is dropped once empty. rollback_db swaps old back.
+    '''
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        if _has_views_or_triggers(cursor, [new, live]):
+            # dbrename keeps no copy of live's tables: clear old anyway,
+            # so the next swap_in or rollback_db does not mix in stale ones
+            _recreate_database(cursor, old)
+            logger.info('Views or triggers present, using ~/bin/dbrename '
+                        '(no rollback to {} this time)'.format(old))
+            subprocess.run([expanduser('~/bin/dbrename'), new, live],
+                           check=True)
+            return
+        cursor.execute('CREATE DATABASE IF NOT EXISTS `{}` character set '
+                       'utf8 collate utf8_general_ci'.format(live))
+        _recreate_database(cursor, old)
+        n = _rename_tables(cursor, [(live, old, _base_tables(cursor, live)),
+                                    (new, live, _base_tables(cursor, new))])
+        cursor.execute('DROP DATABASE `{}`'.format(new))
+        logger.info('Swapped {} tables of {} into {}, previous ones kept '
+                    'in {}'.format(n, new, live, old))
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def rollback_db(connect, live, old, scratch):
+    '''Exchange the tables of live and old (undo swap_in; redo it too)'''
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        old_tables = _base_tables(cursor, old)
+        if not old_tables:
+            raise Exception('Nothing to roll back to: {} is empty or missing'
+                            .format(old))
+        live_tables = _base_tables(cursor, live)
+        _recreate_database(cursor, scratch)
+        _rename_tables(cursor, [(live, scratch, live_tables),
+                                (old, live, old_tables),
+                                (scratch, old, live_tables)])
+        cursor.execute('DROP DATABASE `{}`'.format(scratch))
+        logger.info('Rolled back {} to the tables from {}'.format(live, old))
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def warm_buffer_pool(connect, dbname):
+    '''Read every table's primary key once, so the first requests after
+    the swap don't have to fetch it from disk'''
+    from MySQLdb import MySQLError
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        for table in _base_tables(cursor, dbname):
+            try:
+                cursor.execute('SELECT COUNT(*) FROM `{}`.`{}` '
+                               'FORCE INDEX (PRIMARY)'.format(dbname, table))
+            except MySQLError:
+                cursor.execute('SELECT COUNT(*) FROM `{}`.`{}`'.format(
+                    dbname, table))
+            cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def replace_db(dbfile, jobs=None, tee=None, fast=False, rules=None,
+               before_swap=None, warm=False):
+    '''dbfile - reads the dump from stdin, saving a copy to tee if given
+
+    fast: bulk-load settings (BULK_SESSION, BULK_GLOBAL) during the load
+    rules: TableRules, to leave out or cut down tables (see tablefilter)
+    before_swap: called with settings pointing at the loaded _tmp
+    database, to migrate and fix it up while the live one is untouched
+    warm: read the new tables into the buffer pool before the swap
+    The live database's previous tables are kept in <name>_old.
+    Returns the LoadProgress record of the load.
+    '''
+    if dbfile != '-' and not exists(expanduser(dbfile)):
         for f in (expanduser(dbfile) + '.sql.gz',
-                  expanduser('~/u/' + dbfile + '.sql.gz')):
+                  expanduser(dbfile) + '.sql.tar',
+                  expanduser('~/u/' + dbfile + '.sql.gz'),
+                  expanduser('~/u/' + dbfile + '.sql.tar')):
             if exists(f):
                 dbfile = f
                 break
@@ -34,6 +438,7 @@ def replace_db(dbfile):
             raise Exception('{} not found'.format(dbfile))
     logger.debug('Replacing db from {}'.format(dbfile))
 
+    from django.conf import settings
     db = settings.DATABASES['default']
     orig_dbname = db['NAME']
     dbname = orig_dbname + '_tmp'
@@ -44,99 +449,179 @@ def replace_db(dbfile):
 
     # drop and recreate database
     logger.debug(f"mariadb connect user={db['USER']}")
-    rootdb = mysql.connect(user=db['USER'], passwd=db['PASSWORD'])
+
+    def connect():
+        return mysql_connect(db)
+
+    rootdb = connect()
     c = rootdb.cursor()
-    try:
-        c.execute('drop database %s' % dbname)
-        logger.debug('Dropped database {}'.format(dbname))
-    except:
-        pass                              # ignore drop database errors
-    c.execute('create database {} character set utf8 '
-              'collate utf8_general_ci'.format(dbname))
-    logger.debug('Created database {}'.format(dbname))
+    with phase('create'):
+        try:
+            c.execute('drop database %s' % dbname)
+            logger.debug('Dropped database {}'.format(dbname))
+        except:
+            pass                          # ignore drop database errors
+        c.execute('create database {} character set utf8 '
+                  'collate utf8_general_ci'.format(dbname))
+        logger.debug('Created database {}'.format(dbname))
+        prelude = b''
+        if fast:
+            c.execute('SELECT @@log_bin')
+            prelude = session_prelude(c, c.fetchone()[0])
     c.close()
     rootdb.close()
 
     logger.info('replacedb started at {0:%H:%M:%S}'.format(datetime.now()))
-    # now load the data. For that first gunzip it,
-    # then run mysql in a subprocess
-    cmd = ['mariadb', '-u', db['USER'], f"--password={db['PASSWORD']}", dbname]
-    logger.debug(f'Running: {cmd}')
-    unzipproc = subprocess.Popen(['gunzip', '--stdout', dbfile],
-                                 stdout=subprocess.PIPE)
-    mysqlproc = subprocess.Popen(cmd, stdin=unzipproc.stdout,
-                                 stdout=subprocess.PIPE)
-    unzipproc.stdout.close()
-    logger.debug('Waiting for gunzip|mariadb process')
-    mysqlproc.wait()
-    logger.debug(f'Successfully created {dbname}. Now renaming.')
-    subprocess.run([expanduser('~/bin/dbrename'), dbname, orig_dbname],
-                   check=True)
+    record = None
+    with bulk_load_settings(connect) if fast else nullcontext():
+        if dbfile == '-':
+            with phase('load'):
+                record = load_stream(db, dbname, sys.stdin.buffer, tee,
+                                     prelude, rules=rules)
+        elif is_sharded_dump(dbfile):
+            record = load_sharded(db, dbname, dbfile, jobs or cpu_count(),
+                                  prelude, rules)
+        else:
+            with phase('load'):
+                record = load_file(db, dbname, dbfile, prelude, rules)
+    logger.debug(f'Successfully created {dbname}.')
+
+    if before_swap:
+        db['NAME'] = dbname
+        try:
+            before_swap()
+        finally:
+            db['NAME'] = orig_dbname
+            from django.db import connections
+            connections.close_all()       # no metadata locks on the swap
+    if warm:
+        with phase('warm'):
+            warm_buffer_pool(connect, dbname)
+    with phase('swap'):
+        swap_in(connect, dbname, orig_dbname, orig_dbname + '_old')
     logger.info(f'replaced db: {dbname} with {orig_dbname}')
-    # notifications_TODO: truncate the notifications
-    # mydb = mysql.connect(user=db['USER'],
-    #                     passwd=db['PASSWORD'],
-    #                     db=db['NAME'])
-
-parser = argparse.ArgumentParser()
-parser.add_argument('-D', '--demo', action='store_true',
-                    help='Prep db for demo after loading')
-parser.add_argument('-d', '--debug', action='store_true',
-                    help='log debug messages to stderr')
-parser.add_argument('-p', '--project-path', nargs='*',
-                    help='directories to add to project path')
-parser.add_argument('-s', '--settings-module',
-                    default='settings',
-                    help='settings for DJANGO_SETTINGS_MODULE')
-parser.add_argument('-v', '--verbose', action='store_true',
-                    help='log messages to console')
-parser.add_argument('-f', '--fixdemoscript',
-                    default='scripts.pyfixtures.fix_demo',
-                    help='dotted path for fix_demo script')
-parser.add_argument('-n', '--no-syncdb',
-                    action='store_true',
-                    help='dont do syncdb or migrate')
-parser.add_argument('-r', '--register-evaluators', action='store_true',
-                    help='register evaluators for reliscore')
-parser.add_argument('file', help='Dump of database')
-
-args = parser.parse_args()
-handlers = 'console,file' if args.verbose else 'file'
-fileConfig(expanduser('~/.pylog.cfg'),
-           defaults=dict(
-               logfile=expanduser('~/logs/replacedb.log'),
-               root_handlers=handlers,
-           ),
-           disable_existing_loggers=False)
-
-if args.debug:
-    logger.setLevel(logging.DEBUG)
-else:
-    logger.setLevel(logging.INFO)
-
-
-for path_el in args.project_path[::-1]:
-    sys.path.insert(0, abspath(expanduser(path_el)))
-    # insert in reverse order to get correct order
-if args.settings_module:
-    os.environ.setdefault('DJANGO_SETTINGS_MODULE', args.settings_module)
-
-# Ughhh. HACK. To make dbrename work properly
-os.environ.setdefault('HOME', expanduser('~'))
-
-replace_db(args.file)
-
-if args.no_syncdb:
-    logger.info('Skipping sync commands')
-    cmds = []
-else:
-    cmds = [['migrate']]
-
-if args.register_evaluators:
-    cmds += [['register_evaluators', '-f', '-c', 'reliscore']]
-
-if args.demo:
-    cmds.append(['runcmd', args.fixdemoscript])
-for cmd in cmds:
-    logger.info('Executing: <manage.py> {}'.format(cmd))
-    execute_from_command_line([sys.argv[0]] + cmd)
+    return record
+
+def make_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-D', '--demo', action='store_true',
+                        help='Prep db for demo after loading')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='log debug messages to stderr')
+    parser.add_argument('-p', '--project-path', nargs='*',
+                        help='directories to add to project path')
+    parser.add_argument('-s', '--settings-module',
+                        default='settings',
+                        help='settings for DJANGO_SETTINGS_MODULE')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log messages to console')
+    parser.add_argument('-f', '--fixdemoscript',
+                        default='scripts.pyfixtures.fix_demo',
+                        help='dotted path for fix_demo script')
+    parser.add_argument('-n', '--no-syncdb',
+                        action='store_true',
+                        help='dont do syncdb or migrate')
+    parser.add_argument('-r', '--register-evaluators', action='store_true',
+                        help='register evaluators for reliscore')
+    parser.add_argument('-j', '--jobs', type=int, default=cpu_count(),
+                        help='parallel loaders for sharded (.sql.tar) dumps')
+    parser.add_argument('-t', '--tee',
+                        help='with file -, save a copy of the dump read from '
+                        'stdin here')
+    parser.add_argument('-F', '--fast', action='store_true',
+                        help='bulk-load settings while loading: no unique/FK '
+                        'checks, big transactions, no binlog, lazy log flush')
+    parser.add_argument('--filter', action='append',
+                        help='TABLE=exclude|schema|recent:N[:COLUMN]|'
+                        'where:CONDITION, see tablefilter.py')
+    parser.add_argument('--filter-file',
+                        help='JSON file of {TABLE: ACTION} filter rules')
+    parser.add_argument('-w', '--warm', action='store_true',
+                        help='warm the InnoDB buffer pool before the swap')
+    parser.add_argument('--rollback', action='store_true',
+                        help='swap the previous database (<name>_old) back in '
+                        'instead of loading a dump')
+    parser.add_argument('file', nargs='?', help='Dump of database, - for stdin')
+    return parser
+
+
+def run_commands(cmds):
+    '''manage.py commands, all in this process after one django.setup()'''
+    if not cmds:
+        return
+    import django
+    from django.core.management import call_command
+    django.setup()
+    for cmd in cmds:
+        logger.info('Executing: <manage.py> {}'.format(cmd))
+        with phase(cmd[0]):
+            call_command(*cmd)
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if not args.file and not args.rollback:
+        parser.error('the dump file is required (or --rollback)')
+    handlers = 'console,file' if args.verbose else 'file'
+    fileConfig(expanduser('~/.pylog.cfg'),
+               defaults=dict(
+                   logfile=expanduser('~/logs/replacedb.log'),
+                   root_handlers=handlers,
+               ),
+               disable_existing_loggers=False)
+
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    for path_el in (args.project_path or [])[::-1]:
+        sys.path.insert(0, abspath(expanduser(path_el)))
+        # insert in reverse order to get correct order
+    if args.settings_module:
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', args.settings_module)
+
+    # Ughhh. HACK. To make dbrename work properly
+    os.environ.setdefault('HOME', expanduser('~'))
+
+    if args.rollback:
+        from django.conf import settings
+        db = settings.DATABASES['default']
+        rollback_db(lambda: mysql_connect(db), db['NAME'],
+                    db['NAME'] + '_old', db['NAME'] + '_tmp')
+        return
+
+    if args.no_syncdb:
+        logger.info('Skipping sync commands')
+        cmds = []
+    else:
+        cmds = [['migrate']]
+
+    if args.register_evaluators:
+        cmds += [['register_evaluators', '-f', '-c', 'reliscore']]
+
+    if args.demo:
+        cmds.append(['runcmd', args.fixdemoscript])
+
+    table_rules = TableRules.load(args.filter_file, args.filter)
+    if table_rules:
+        logger.info('Table filters: {}'.format(
+            ' '.join(str(rule) for rule in table_rules.rules)))
+    load_record = replace_db(args.file, jobs=args.jobs, tee=args.tee,
+                             fast=args.fast, rules=table_rules,
+                             before_swap=lambda: run_commands(cmds),
+                             warm=args.warm)
+    logger.info(phase.summary())
+    # one JSON line per restore, for comparing runs:
+    # grep 'timing {' replacedb.log
+    logger.info('timing ' + json.dumps(dict(
+        file=args.file,
+        fast=args.fast,
+        phases=[dict(name=name, seconds=round(seconds, 3))
+                for name, seconds in phase.phases],
+        load=load_record)))
+
+
+if __name__ == '__main__':
+    main()
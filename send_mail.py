@@ -1,6 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import json
+import os
 import requests
-from urllib.error import HTTPError
+import requests.adapters
+import threading
+import time
+import urllib3
 
 from django.conf import settings
 
@@ -9,28 +15,108 @@ try:
 except ImportError:
     sendgrid = None
 
+SENDGRID_MAX_RECIPIENTS = 990     # per request; the API allows 1000
+SENDGRID_API_URL = 'https://api.sendgrid.com/v3/mail/send'
+MANDRILL_API_URL = 'https://mandrillapp.com/api/1.0/messages/send.json'
+
 
 class MailError(Exception):
-    pass
+    def __init__(self, message, status_code=None, connect_failed=False):
+        super(MailError, self).__init__(message)
+        self.status_code = status_code
+        self.connect_failed = connect_failed
 
+    @property
+    def retryable(self):
+        '''Throttled, a server error, or the server could not be reached
+        (so nothing was sent): worth trying again later'''
+        return self.connect_failed or self.status_code == 429 or \
+            (self.status_code or 0) >= 500
 
-def sendgrid_core_send(data):
-    '''data can be a sendgrid.Mail object or a dict'''
-    sg = sendgrid.SendGridAPIClient(api_key=settings.SENDGRID_KEY)
+
+# One HTTP session (and so one keep-alive connection pool) per process,
+# shared by all threads. requests.Session is safe to share for posting.
+# Settings: MAIL_HTTP_POOL_SIZE, MAIL_HTTP_TIMEOUT (connect, read),
+# SENDGRID_API_URL and MANDRILL_API_URL (e.g. for a local mock server).
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def _reset_session():
+    '''After fork, the child must not use the parent's connections'''
+    global _session, _session_pid, _session_lock
+    _session = _session_pid = None
+    _session_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_session)
+
+
+def http_session():
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                pool_size = getattr(settings, 'MAIL_HTTP_POOL_SIZE', 10)
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=2, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session, _session_pid = session, os.getpid()
+    return _session
+
+
+def http_timeout():
+    return getattr(settings, 'MAIL_HTTP_TIMEOUT', (5, 30))
+
+
+def _post(url, **kwargs):
+    '''POST on the shared session, failures raised as MailError'''
     try:
-        if isinstance(data, sendgrid.Mail):
-            response = sg.send(data)
-        else:
-            response = sg.client.mail.send.post(request_body=data)
-    except (HTTPError) as e:
-        raise MailError('HTTPError: {}'.format(e.body))
-    except Exception as e:
-        raise MailError('Unknown Exception: {}'.format(e))
-
-    if response.status_code % 100 != 2:  # not 2xx
+        return http_session().post(url, timeout=http_timeout(), **kwargs)
+    except requests.RequestException as e:
+        # refused, DNS, connect timeout: the request never got there, so
+        # it is safe to retry. A connection lost later may have sent it.
+        reason = getattr(e.args[0] if e.args else None, 'reason', None)
+        connect_failed = isinstance(e, requests.ConnectTimeout) or \
+            isinstance(reason, urllib3.exceptions.NewConnectionError)
+        raise MailError('Request failed: {}'.format(e),
+                        connect_failed=connect_failed)
+
+
+class SendGridResponse(object):
+    '''What the sendgrid client's send used to return (status_code, body,
+    headers, to_dict), over a requests.Response'''
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.body = response.content
+        self.headers = response.headers
+
+    @property
+    def to_dict(self):
+        return json.loads(self.body) if self.body else None
+
+
+def sendgrid_core_send(data):
+    '''data can be a sendgrid.Mail object or a dict
+
+    Returns a SendGridResponse, like the sendgrid client's response.
+    '''
+    if sendgrid is not None and isinstance(data, sendgrid.Mail):
+        data = data.get()
+    response = _post(
+        getattr(settings, 'SENDGRID_API_URL', SENDGRID_API_URL),
+        json=data,
+        headers={'Authorization': 'Bearer ' + settings.SENDGRID_KEY})
+
+    if response.status_code // 100 != 2:  # not 2xx
         raise MailError("status={}, body={}".format(
-            response.status_code, response.body))
-    return response
+            response.status_code, response.text), response.status_code)
+    return SendGridResponse(response)
 
 
 def sendgrid_send(subject,
@@ -43,7 +129,8 @@ def sendgrid_send(subject,
 
     # Validations
     to_emails = set(e.lower() for e in to_emails)
-    if len(to_emails) + len(cc_emails) + len(bcc_emails) > 990:
+    if len(to_emails) + len(cc_emails) + len(bcc_emails) > \
+       SENDGRID_MAX_RECIPIENTS:
         raise MailError('Too many to_emails: {}. Break into chunks'.format(
             len(to_emails)))
     for e in cc_emails + bcc_emails:
@@ -91,7 +178,7 @@ def sendgrid_send_template(template_id,
     contexts = [['navin@smriti.com', {'username': 'ngkabra'}], ['t@example.com', {'username': 'testuser1'}]]
     common_context = {'company_name': 'ReliScore', 'test_name': 'Software Engineer'}
     '''
-    if len(contexts) > 990:
+    if len(contexts) > SENDGRID_MAX_RECIPIENTS:
         raise MailError('Too many emails: {}. Break into chunks'.format(
             len(contexts)))
     
@@ -115,7 +202,123 @@ def sendgrid_send_template(template_id,
     message.template_id = template_id
     
     return sendgrid_core_send(message)
-    
+
+
+class RateLimiter(object):
+    '''Allow at most rate calls to wait() per second, across threads'''
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        time.sleep(start - now)
+
+
+def send_with_retry(send, *args, retries=5, backoff=1.0, limiter=None):
+    '''send(*args), retrying 429s and 5xx with exponential backoff'''
+    for attempt in range(retries + 1):
+        if limiter:
+            limiter.wait()
+        try:
+            return send(*args)
+        except MailError as e:
+            if not e.retryable or attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def sendgrid_bulk_send(items, build_data, batch_size=SENDGRID_MAX_RECIPIENTS,
+                       workers=4, rate=None, retries=5, backoff=1.0):
+    '''Send to any number of recipients in full-size batches
+
+    items: iterable of (email, context); read lazily
+    build_data(batch): sendgrid request body for a list of items
+    workers: batches in flight at once
+    rate: at most this many requests per second (None: no limit)
+    429 and 5xx responses are retried with exponential backoff.
+
+    Returns [(email, error)] in input order, error None if sent.
+    '''
+    limiter = RateLimiter(rate)
+    in_flight = threading.BoundedSemaphore(workers * 2)
+
+    def send_batch(batch):
+        try:
+            send_with_retry(sendgrid_core_send, build_data(batch),
+                            retries=retries, backoff=backoff,
+                            limiter=limiter)
+            error = None
+        except MailError as e:
+            error = str(e)
+        finally:
+            in_flight.release()
+        return [(email, error) for email, context in batch]
+
+    futures = []
+    with ThreadPoolExecutor(workers) as pool:
+        for batch in _chunks(items, batch_size):
+            in_flight.acquire()    # don't read items far ahead of sending
+            futures.append(pool.submit(send_batch, batch))
+    return [result for f in futures for result in f.result()]
+
+
+def sendgrid_send_template_bulk(
+        template_id, contexts, common_context,
+        from_email=settings.DEFAULT_REGISTRATIONS_FROM_EMAIL,
+        from_email_name="ReliScore Registrations (do not reply)",
+        **kwargs):
+    '''sendgrid_send_template without the 990 recipient limit
+
+    contexts is an iterable of [email, specific_context], of any length.
+    Other kwargs as for sendgrid_bulk_send, which has the return value.
+    '''
+    def build_data(batch):
+        return {
+            "personalizations": [
+                {"to": [{"email": email}],
+                 "dynamic_template_data": {**specific_context,
+                                           **common_context}}
+                for email, specific_context in batch],
+            "from": {"email": from_email, "name": from_email_name},
+            "template_id": template_id,
+        }
+    return sendgrid_bulk_send(contexts, build_data, **kwargs)
+
+
+def sendgrid_send_bulk(subject, message, from_email, to_emails,
+                       from_email_name="ReliScore Admin", **kwargs):
+    '''Send message to each of to_emails separately, in batches
+
+    Recipients don't see each other. Other kwargs as for
+    sendgrid_bulk_send, which has the return value.
+    '''
+    def build_data(batch):
+        return {
+            "personalizations": [
+                {"to": [{"email": email}], "subject": subject}
+                for email, _ in batch],
+            "from": {"email": from_email, "name": from_email_name},
+            "content": [{"type": "text/plain", "value": message}],
+        }
+    return sendgrid_bulk_send(((e, None) for e in to_emails), build_data,
+                              **kwargs)
+
 
 def mandrill_send(subject,
                   message,
@@ -142,7 +345,14 @@ def mandrill_send(subject,
             },
         },
     }
-    res = requests.post('https://mandrillapp.com/api/1.0/messages/send.json',
-                        data=json.dumps(data))
-    # ignore errors
-    # for now, ignore value of fail_silently
+    try:
+        res = _post(getattr(settings, 'MANDRILL_API_URL', MANDRILL_API_URL),
+                    data=json.dumps(data))
+        if res.status_code // 100 != 2:  # not 2xx
+            raise MailError("status={}, body={}".format(
+                res.status_code, res.text), res.status_code)
+    except MailError:
+        if fail_silently:
+            return None
+        raise
+    return res
@@ -0,0 +1,115 @@
+'''One reusable ssh connection per host for the tasks in tasks.py
+
+Two layers:
+
+* fabric Connections (c.run, c.get and its SFTP session) are kept in a
+  per-host pool, checked and reopened when the transport has died, and
+  closed after sitting idle.
+* external ssh users (rsync -e, ssh pipes) go through an OpenSSH
+  ControlMaster socket, so they share one handshake per host as well.
+  ControlPersist closes the master after the same idle timeout.
+'''
+from contextlib import contextmanager
+import socket
+import threading
+import time
+
+import paramiko
+
+IDLE_TIMEOUT = 600            # seconds before an unused connection is closed
+KEEPALIVE = 30                # seconds between ssh keepalives
+CONNECT_RETRIES = 3
+CONTROL_PATH = '~/.ssh/cm-%C'
+
+_pool = {}                    # host -> [conn, last_used, users]
+_lock = threading.Lock()
+
+
+def ssh_options(idle_timeout=IDLE_TIMEOUT):
+    return ['-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={}'.format(CONTROL_PATH),
+            '-o', 'ControlPersist={}'.format(idle_timeout),
+            '-o', 'ServerAliveInterval={}'.format(KEEPALIVE)]
+
+
+def ssh_command(idle_timeout=IDLE_TIMEOUT):
+    '''ssh command line for rsync -e and pipes, multiplexed per host
+
+    Has no quotes or spaces inside options, so it can be put in quotes.
+    ssh expands the ~ in ControlPath itself.
+    '''
+    return ' '.join(['ssh'] + ssh_options(idle_timeout))
+
+
+def ensure_connected(conn, retries=CONNECT_RETRIES):
+    '''Open conn, or reopen it if its transport died. Retries with backoff'''
+    if conn.is_connected:
+        return conn
+    for attempt in range(retries):
+        try:
+            conn.close()              # drop dead transport and cached sftp
+            conn.open()
+            conn.transport.set_keepalive(KEEPALIVE)
+            return conn
+        except (socket.error, paramiko.SSHException, EOFError):
+            if attempt == retries - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+
+def _close_idle(now, idle_timeout):
+    '''Close connections idle for too long. Ones in use are never idle'''
+    for host, (conn, last_used, users) in list(_pool.items()):
+        if not users and now - last_used > idle_timeout:
+            conn.close()
+            del _pool[host]
+
+
+def get_connection(host, config, connection_class, idle_timeout=IDLE_TIMEOUT):
+    '''Pooled connection for host, opened and ready for use
+
+    The connection counts as in use (and so is not closed as idle)
+    until release_connection(host). See pooled_connection.
+    '''
+    now = time.time()
+    with _lock:
+        _close_idle(now, idle_timeout)
+        entry = _pool.get(host)
+        if entry is None:
+            entry = _pool[host] = [connection_class(host, config=config),
+                                   now, 0]
+        entry[1] = now
+        entry[2] += 1
+        conn = entry[0]
+    try:
+        return ensure_connected(conn)
+    except BaseException:
+        release_connection(host)
+        raise
+
+
+def release_connection(host):
+    '''Done with a connection from get_connection: it may now idle'''
+    with _lock:
+        entry = _pool.get(host)
+        if entry is not None:
+            entry[1] = time.time()
+            entry[2] = max(entry[2] - 1, 0)
+
+
+@contextmanager
+def pooled_connection(host, config, connection_class,
+                      idle_timeout=IDLE_TIMEOUT):
+    '''get_connection and release_connection around a with block'''
+    conn = get_connection(host, config, connection_class, idle_timeout)
+    try:
+        yield conn
+    finally:
+        release_connection(host)
+
+
+def close_all():
+    with _lock:
+        for conn, last_used, users in _pool.values():
+            conn.close()
+        _pool.clear()
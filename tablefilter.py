@@ -0,0 +1,256 @@
+'''Table filter rules for partial dumps and restores
+
+A rule is TABLE=ACTION, where TABLE may be a glob (notifications_*):
+
+    TABLE=exclude               no schema, no data
+    TABLE=schema                schema only, no rows
+    TABLE=recent:N[:COLUMN]     only the N rows with the highest COLUMN
+                                (default id)
+    TABLE=where:CONDITION       only the rows matching an SQL condition
+
+Rules come from --filter options, or from a JSON file given with
+--filter-file that maps TABLE to ACTION:
+
+    {"notifications_*": "exclude", "audit_log": "schema",
+     "events": "recent:10000", "submissions": "where:created > '2024-01-01'"}
+
+dumpdb applies them with mysqldump options. replacedb applies them to
+the SQL stream as it is loaded. There, recent keeps the last N rows of
+the table in the dump (mysqldump writes rows in primary key order).
+where cannot be evaluated on the stream: the rows are loaded and those
+not matching are deleted at the end (rows where the condition is NULL
+count as not matching, as with mysqldump --where). Filter at dump time
+to save that.
+
+Never filter the dumps that are kept as backups.
+Nothing in here imports django.
+'''
+from collections import deque
+from fnmatch import fnmatchcase
+import json
+import re
+
+ACTIONS = ('exclude', 'schema', 'recent', 'where')
+INSERT_BATCH = 1 << 20            # bytes of rows per re-written INSERT
+
+
+class FilterError(Exception):
+    pass
+
+
+class Rule(object):
+    def __init__(self, pattern, action, count=None, column='id', where=None):
+        self.pattern = pattern
+        self.action = action
+        self.count = count
+        self.column = column
+        self.where = where
+
+    @classmethod
+    def parse(cls, text):
+        pattern, sep, action = text.partition('=')
+        name, _, arg = action.partition(':')
+        if not sep or not pattern or name not in ACTIONS:
+            raise FilterError('Bad filter rule {!r}: expected TABLE={}'.format(
+                text, '|'.join(ACTIONS)))
+        if name == 'recent':
+            count, _, column = arg.partition(':')
+            if not count.isdigit():
+                raise FilterError('Bad filter rule {!r}: recent:N'.format(text))
+            return cls(pattern, name, count=int(count), column=column or 'id')
+        if name == 'where':
+            if not arg:
+                raise FilterError('Bad filter rule {!r}: where:CONDITION'
+                                  .format(text))
+            return cls(pattern, name, where=arg)
+        return cls(pattern, name)
+
+    def dump_where(self):
+        '''Condition for mysqldump --where (LIMIT rides along after it)'''
+        if self.action == 'recent':
+            return '1 ORDER BY `{}` DESC LIMIT {}'.format(self.column,
+                                                          self.count)
+        return self.where
+
+    def __str__(self):
+        arg = {'recent': '{}:{}'.format(self.count, self.column),
+               'where': self.where}.get(self.action)
+        return '{}={}{}'.format(self.pattern, self.action,
+                                ':' + arg if arg else '')
+
+
+class TableRules(object):
+    '''Ordered rules; the first whose pattern matches a table applies'''
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+
+    @classmethod
+    def load(cls, path=None, texts=()):
+        rules = []
+        if path:
+            with open(path) as f:
+                for pattern, action in json.load(f).items():
+                    rules.append(Rule.parse('{}={}'.format(pattern, action)))
+        rules += [Rule.parse(text) for text in texts or ()]
+        return cls(rules)
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def get(self, table):
+        if table is None:
+            return None
+        for rule in self.rules:
+            if fnmatchcase(table, rule.pattern):
+                return rule
+        return None
+
+    def action(self, table):
+        rule = self.get(table)
+        return rule.action if rule else None
+
+    def mysqldump_runs(self, dbname, tables):
+        '''[(mysqldump options, tables)] whose outputs, concatenated,
+        are the dump. tables [] means the whole database.
+
+        The first run dumps every table with no rule. Schema-only tables
+        get one --no-data run, and each recent/where table a run of its
+        own.
+        '''
+        runs = [(['--ignore-table={}.{}'.format(dbname, t)
+                  for t in tables if self.get(t)], [])]
+        schema = [t for t in tables if self.action(t) == 'schema']
+        if schema:
+            runs.append((['--no-data', '--skip-triggers'], schema))
+        for table in tables:
+            rule = self.get(table)
+            if rule and rule.action in ('recent', 'where'):
+                runs.append((['--where={}'.format(rule.dump_where())],
+                             [table]))
+        return runs
+
+
+_STATEMENT_TABLE_RE = re.compile(
+    rb'^(?:DROP TABLE IF EXISTS|CREATE TABLE|LOCK TABLES|INSERT INTO|'
+    rb'/\*!\d+ ALTER TABLE|ALTER TABLE) `([^`]+)`')
+_TRIGGER_TABLE_RE = re.compile(rb'\bTRIGGER\b.*?\bON `([^`]+)`', re.S)
+_ROW_RE = re.compile(rb"\((?:[^()'\\]|'(?:[^'\\]|\\.)*'|\\.)*\)", re.S)
+
+
+def _rows(insert):
+    '''The (...) value tuples of an INSERT INTO ... VALUES line'''
+    values = insert[insert.index(b' VALUES ') + len(b' VALUES '):]
+    return _ROW_RE.findall(values)
+
+
+def _inserts(table, rows):
+    '''Yield INSERT statements for rows, INSERT_BATCH bytes at a time'''
+    head = b'INSERT INTO `%s` VALUES ' % table
+    batch, size = [], 0
+    for row in rows:
+        batch.append(row)
+        size += len(row)
+        if size >= INSERT_BATCH:
+            yield head + b','.join(batch) + b';\n'
+            batch, size = [], 0
+    if batch:
+        yield head + b','.join(batch) + b';\n'
+
+
+def _lines(chunks):
+    '''Re-chunk into whole lines, newline included'''
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if rest:
+        yield rest
+
+
+def filter_sql(chunks, rules):
+    '''Apply rules to a stream of mysqldump output (chunks of bytes)
+
+    Statements of excluded tables (DDL, data, locks, triggers) are
+    dropped, and so are the rows of schema-only tables. recent tables
+    keep only their last N rows. Rows not matching where rules are
+    deleted by statements added at the end.
+    '''
+    if not rules:
+        yield from chunks
+        return
+    seen = set()
+    skip_unlock = False
+    recent = None                   # (table, deque of rows) being collected
+    statement = []                  # multi-line statement being read
+    statement_table = terminator = None
+
+    def flush_recent():
+        table, rows = recent
+        return b''.join(_inserts(table, rows))
+
+    for line in _lines(chunks):
+        if statement:
+            statement.append(line)
+            if line.rstrip().endswith(terminator):
+                if rules.action(statement_table) != 'exclude':
+                    yield b''.join(statement)
+                statement = []
+            continue
+
+        match = _STATEMENT_TABLE_RE.match(line)
+        table = match.group(1).decode('utf8') if match else None
+        if table and line.startswith(b'INSERT INTO'):
+            seen.add(table)
+        if recent and not (table == recent[0].decode('utf8')
+                           and line.startswith(b'INSERT INTO')):
+            yield flush_recent()
+            recent = None
+
+        if line.startswith(b'UNLOCK TABLES') and skip_unlock:
+            skip_unlock = False
+            continue
+        if line.startswith(b'/*!50003 CREATE*/') or \
+           line.startswith(b'CREATE TABLE'):
+            # triggers run up to ;; (DELIMITER ;;), tables up to ;
+            trigger = _TRIGGER_TABLE_RE.search(line)
+            statement_table = trigger.group(1).decode('utf8') \
+                if trigger else table
+            terminator = b';;' if line.startswith(b'/*!50003') else b';'
+            if line.rstrip().endswith(terminator):
+                if rules.action(statement_table) != 'exclude':
+                    yield line
+            else:
+                statement = [line]
+            continue
+        if table is None:
+            yield line
+            continue
+
+        action = rules.action(table)
+        if action == 'exclude':
+            if line.startswith(b'LOCK TABLES'):
+                skip_unlock = True
+            continue
+        if line.startswith(b'INSERT INTO'):
+            if action == 'schema':
+                continue
+            if action == 'recent':
+                if recent is None:
+                    recent = (match.group(1),
+                              deque(maxlen=rules.get(table).count))
+                recent[1].extend(_rows(line))
+                continue
+        yield line
+
+    if statement:
+        yield b''.join(statement)
+    if recent:
+        yield flush_recent()
+    deletes = [b'DELETE FROM `%s` WHERE NOT COALESCE((%s), FALSE);\n' % (
+        t.encode('utf8'), rules.get(t).where.encode('utf8'))
+               for t in sorted(seen) if rules.action(t) == 'where']
+    if deletes:
+        yield b'SET FOREIGN_KEY_CHECKS=0;\n' + b''.join(deletes) + \
+            b'SET FOREIGN_KEY_CHECKS=1;\n'
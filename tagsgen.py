@@ -0,0 +1,145 @@
+#!/usr/bin/python
+'''Build all the emacs TAGS variants in one pass over the project
+
+Walks the tree once, parses every source file once, and writes each
+TAGS_* variant from those results. With incremental=True, parse results
+are cached in .tags_cache and only files whose size or mtime changed are
+parsed again.
+
+    python tagsgen.py [-i] [projdir]
+'''
+import argparse
+import os
+from os.path import exists, join, splitext
+import pickle
+import re
+import time
+
+try:
+    from .dumputils import atomic_output
+except ImportError:
+    # run as a script
+    from dumputils import atomic_output
+
+CACHE_FILE = '.tags_cache'
+EXTENSIONS = ('.html', '.py', '.js', '.sass')
+
+# name, skip ./autoevals, extensions included
+VARIANTS = [
+    ('TAGS', False, ('.html', '.py', '.js', '.sass')),
+    ('TAGS_NOEVALS', True, ('.html', '.py', '.js', '.sass')),
+    ('TAGS_NOHTMLNOJS', False, ('.py', '.sass')),
+    ('TAGS_ONLYJSHTML', True, ('.js', '.sass', '.html')),
+    ('TAGS_ONLYPY', True, ('.py', '.sass')),
+    ('TAGS_ONLYPYHTML', True, ('.py', '.html', '.sass')),
+]
+
+TAG_PATTERNS = {
+    '.py': [rb'^[ \t]*(?:async[ \t]+)?(?:def|class)[ \t]+(\w+)'],
+    '.js': [rb'^[ \t]*(?:export[ \t]+)?(?:async[ \t]+)?function\*?[ \t]+([\w$]+)',
+            rb'^[ \t]*(?:export[ \t]+)?class[ \t]+([\w$]+)',
+            rb'^[ \t]*(?:(?:var|let|const)[ \t]+)?([\w$.]+)[ \t]*[:=][ \t]*'
+            rb'(?:async[ \t]+)?(?:function\b|\([^)\n]*\)[ \t]*=>)'],
+    '.sass': [rb'^[ \t]*(?:=|@mixin[ \t]+|@function[ \t]+)([\w-]+)',
+              rb'^[ \t]*\$([\w-]+)[ \t]*:'],
+    # like etags: the title, h1-h3 headers, ids, and names of anchors
+    '.html': [rb'(?i)<title>[ \t]*([^<\n]*[^<\s])[ \t]*</title>',
+              rb'(?i)<h[123]\b[^>\n]*>[ \t]*([^<\n]*[^<\s])[ \t]*</h[123]>',
+              rb'(?i)\bid=["\']([^"\'\n]+)["\']',
+              rb'(?i)<a\b[^>\n]*\bname=["\']([^"\'\n]+)["\']'],
+}
+TAG_PATTERNS = {ext: [re.compile(p, re.M) for p in patterns]
+                for ext, patterns in TAG_PATTERNS.items()}
+
+
+def walk_sources(root):
+    '''Yield ./relative paths like find, skipping migrations directories
+
+    Migrations are left out of every variant. (The find commands this
+    replaced pruned them only for TAGS and TAGS_NOHTMLNOJS: in the
+    others, -prune after ./autoevals never reached *migrations.)
+    '''
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames
+                             if not d.endswith('migrations'))
+        rel = os.path.relpath(dirpath, root)
+        reldir = '.' if rel == '.' else './' + rel.replace(os.sep, '/')
+        for name in sorted(filenames):
+            if splitext(name)[1] in EXTENSIONS:
+                yield reldir + '/' + name
+
+
+def parse_tags(data, ext):
+    '''etags entries for the source in data, as one bytes section'''
+    matches = sorted((m for pattern in TAG_PATTERNS[ext]
+                      for m in pattern.finditer(data)),
+                     key=lambda m: m.start())
+    entries = []
+    lineno, pos = 1, 0
+    for m in matches:
+        start = data.rfind(b'\n', 0, m.start()) + 1
+        lineno += data.count(b'\n', pos, start)
+        pos = start
+        entries.append(b'%s\x7f%s\x01%d,%d\n' % (
+            data[start:m.end(1)], m.group(1), lineno, start))
+    return b''.join(entries)
+
+
+def build_tags(root='.', incremental=False):
+    '''Write every TAGS variant under root. Returns a stats dict'''
+    start = time.time()
+    cache_path = join(root, CACHE_FILE)
+    cache = {}
+    if incremental and exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+
+    sections = {}
+    parsed = 0
+    for path in walk_sources(root):
+        try:
+            st = os.stat(join(root, path))
+            cached = cache.get(path)
+            if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+                sections[path] = cached[2]
+                continue
+            with open(join(root, path), 'rb') as f:
+                data = f.read()
+        except OSError:
+            continue                  # dangling symlink, unreadable file
+        section = parse_tags(data, splitext(path)[1])
+        sections[path] = section
+        cache[path] = (st.st_size, st.st_mtime_ns, section)
+        parsed += 1
+
+    for name, skip_autoevals, extensions in VARIANTS:
+        with atomic_output(join(root, name)) as out:
+            for path, section in sections.items():
+                if splitext(path)[1] not in extensions:
+                    continue
+                if skip_autoevals and path.startswith('./autoevals/'):
+                    continue
+                out.write(b'\x0c\n%s,%d\n' % (path.encode('utf8'),
+                                             len(section)))
+                out.write(section)
+
+    if incremental:
+        cache = {path: cache[path] for path in sections}
+        with atomic_output(cache_path) as f:
+            pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+    return dict(files=len(sections), parsed=parsed,
+                seconds=time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build TAGS files')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='only re-parse files changed since last run')
+    parser.add_argument('root', nargs='?', default='.')
+    args = parser.parse_args()
+    print('{files} files, {parsed} parsed in {seconds:.1f}s'.format(
+        **build_tags(args.root, args.incremental)))
+
+
+if __name__ == '__main__':
+    main()
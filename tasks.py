@@ -1,10 +1,25 @@
 from __future__ import division, absolute_import
 from __future__ import print_function, unicode_literals
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from invoke import task
 from os import symlink, remove
-from os.path import expanduser, join, dirname, lexists
+from os.path import expanduser, join, dirname, lexists, basename
+import sys
+
+from .dumputils import dump_filename, human_bytes
+from .mediaindex import incremental_sync
+from .mediastore import MediaStore
+from .parallel import run_threads, DEFAULT_WORKERS
+from .sshpool import ensure_connected, pooled_connection, ssh_command
+from .tagsgen import build_tags
+from .transfer import fetch, parse_sha256sum, STREAMS
+
+try:
+    from fabric2 import Connection
+except ImportError:
+    from fabric import Connection
 
 
 class BaseConfig():
@@ -93,6 +108,16 @@ class DjangoConfig(BaseConfig):
     def media_backup_dir(self):
         return self.backup_file('media')
 
+    @property
+    def media_store_dir(self):
+        '''Content-addressed media snapshots, see mediastore.py'''
+        return self.backup_file('media-store')
+
+    @property
+    def media_index_file(self):
+        '''Server media index as of the last incremental sync'''
+        return self.backup_file('media-index.sqlite')
+
     @property
     def dumpdb_relfile(self):
         return join('u', self.project + '.sql.gz')
@@ -170,6 +195,17 @@ class LocalConfig(DjangoConfig):
             return self.context.run(cmd, *args, **kwargs)
 
 
+def say(c, *args, err=False, **kwargs):
+    '''print() to c's output (or error) stream
+
+    multi points those at a per-host buffer, so this output gets the
+    host prefix like that of c.run, instead of interleaving on stdout.
+    '''
+    stream = c.config.run.err_stream if err else c.config.run.out_stream
+    print(*args, file=stream or (sys.stderr if err else sys.stdout),
+          **kwargs)
+
+
 def autoconfig(c):
     c.lconfig = LocalConfig(c)
     hoststr = getattr(c, 'host', 'localhost')
@@ -183,17 +219,21 @@ def autoconfig(c):
     else:
         raise Exception('Unknown host: {}'.format(c.host))
 
+    if c.rconfig is not c.lconfig and hasattr(c, 'is_connected'):
+        # reuse c's ssh transport for the whole run, reopening it if it died
+        ensure_connected(c)
+
 
 @task
 def test(c, dir=None):
     autoconfig(c)
-    print('projdir is', c.rconfig.projdir)
-    print('hostname is ', end='')
+    say(c, 'projdir is', c.rconfig.projdir)
+    say(c, 'hostname is ', end='')
     c.run('hostname')
-    print('pwd is ', end='')
+    say(c, 'pwd is ', end='')
     c.run('pwd')
-    print('home is', c.rconfig.home)
-    print('project is', c.rconfig.project)
+    say(c, 'home is', c.rconfig.home)
+    say(c, 'project is', c.rconfig.project)
 
 
 @task
@@ -204,34 +244,68 @@ def restart(c):
 
 
 @task
-def managepy(c, command, local=False):
-    '''Run managepy. Remote by default, but locally if local=True'''
+def managepy(c, command, local=False, worker=None):
+    '''Run managepy. Remote by default, but locally if local=True
+
+    worker: send the command to a warm djworker (see djclient.py),
+    starting one if needed. Defaults to the djworker config setting.'''
     autoconfig(c)
     cfg = c.lconfig if local else c.rconfig
     runner = cfg.lrun if local else c.run
+    if worker is None:
+        worker = getattr(c, 'djworker', False)
+    script = 'dutils/djclient.py --start --' if worker else 'manage.py'
     with c.cd(cfg.managepydir):
-        result = runner("{python} manage.py {command}".format(
-            python=cfg.python, command=command), echo=True)
+        result = runner("{python} {script} {command}".format(
+            python=cfg.python, script=script, command=command), echo=True)
         return result.stdout
 
 
 @task
-def dumpdb(c, dest_file):
+def dumpdb(c, dest_file, stream=False, sharded=False):
+    '''stream: pipe mysqldump into a parallel compressor on the server
+    sharded: one file per table in a .sql.tar, for parallel restore'''
     autoconfig(c)
-    managepy(c, 'dumpdb --output={}'.format(dest_file))
+    options = ''
+    if stream:
+        options += ' --stream'
+    if sharded:
+        options += ' --sharded'
+    managepy(c, 'dumpdb --output={}{}'.format(dest_file, options))
 
 
 @task
-def dumpmedia(c, dest_file=None, tarfile=False):
+def dumpmedia(c, dest_file=None, tarfile=False, incremental=False,
+              snapshot=False):
+    '''rsync media from the server
+
+    incremental: diff the server's media index (manage.py mediaindex)
+    against the one from the last sync, and copy only what changed
+    snapshot: record a deduplicated snapshot in media_store_dir
+    (cheaper than tarfile, use exportmedia to get a .tgz out of it)
+    '''
     autoconfig(c)
     media_rdir = managepy(c, 'mediadir').strip()
     rsync_src = '{host}:{media_rdir}'.format(host=c.host, media_rdir=media_rdir)
     rsync_dest = c.rconfig.media_backup_dir
     mediagz_tsfile = c.rconfig.mediagz_tsfile
 
-    c.local("rsync -avz -e ssh {rsync_src} {rsync_dest}".format(
-        rsync_src=rsync_src,
-        rsync_dest=rsync_dest), echo=True)
+    if incremental:
+        rindex = managepy(c, 'mediaindex').strip().splitlines()[-1]
+        stats = incremental_sync(
+            fetch_index=lambda local_path: c.get(rindex, local_path),
+            run=lambda cmd: c.local(cmd, echo=True),
+            media_src=rsync_src,
+            media_dest=join(rsync_dest, basename(media_rdir)),
+            state_path=c.rconfig.media_index_file,
+            rsh=ssh_command())
+        say(c, 'media sync: {changed} changed, {removed} removed'.format(
+            **stats))
+    else:
+        c.local("rsync -avz -e '{rsh}' {rsync_src} {rsync_dest}".format(
+            rsh=ssh_command(),
+            rsync_src=rsync_src,
+            rsync_dest=rsync_dest), echo=True)
 
     site_media_symlink = join(c.lconfig.managepydir, 'site_media')
     if lexists(site_media_symlink):
@@ -239,6 +313,11 @@ def dumpmedia(c, dest_file=None, tarfile=False):
     symlink('{rsync_dest}/site_media'.format(rsync_dest=rsync_dest),
             site_media_symlink)
 
+    if snapshot:
+        stats = MediaStore(c.rconfig.media_store_dir).snapshot(rsync_dest)
+        say(c, 'media snapshot {name}: {files} files, {read} read, '
+            '{written} bytes new'.format(**stats))
+
     if tarfile:
         # tar.gz the media for backup purposes
         # do this in the background because it takes a long time
@@ -254,25 +333,68 @@ def dumpmedia(c, dest_file=None, tarfile=False):
 
 
 @task
-def getdbonly(c):
+def exportmedia(c, name=None):
+    '''Export media snapshot name (default: latest) to a .tgz'''
     autoconfig(c)
-    dumpdb_relfile = c.rconfig.dumpdb_relfile
+    store = MediaStore(c.rconfig.media_store_dir)
+    name = name or store.snapshots()[-1]
+    mediagz_tsfile = c.rconfig.mediagz_tsfile
+    store.export_tgz(name, mediagz_tsfile)
+    local_mediagz = c.rconfig.mediagz_file
+    if lexists(local_mediagz):
+        remove(local_mediagz)
+    symlink(mediagz_tsfile, local_mediagz)
+
+
+@task
+def restoremedia(c, name, dest):
+    '''Restore media snapshot name into directory dest'''
+    autoconfig(c)
+    MediaStore(c.rconfig.media_store_dir).restore(name, dest)
+
+
+@task
+def getdbonly(c, stream=False, sharded=False, streams=STREAMS,
+              reuse=False):
+    '''Dump the db on the server and download it
+
+    The download is resumable, uses streams parallel SFTP streams, is
+    checked against the server's sha256, and is skipped if today's
+    backup file is already identical.
+    reuse: download the dump already on the server, if there is one,
+    instead of dumping again (e.g. to resume an interrupted download)'''
+    autoconfig(c)
+    dumpdb_relfile = dump_filename(c.rconfig.dumpdb_relfile, sharded)
+    ext = '.sql.tar' if sharded else '.sql.gz'
     rdumpdb_file = join(c.rconfig.home, dumpdb_relfile)
-    dumpdb(c, rdumpdb_file)
-    ldumpdb_tsfile = c.rconfig.timestamped_backup_file('db', '.sql.gz')
+    if reuse and c.run('test -f {}'.format(rdumpdb_file), warn=True,
+                       hide=True).ok:
+        say(c, 'Reusing {}'.format(rdumpdb_file))
+    else:
+        dumpdb(c, rdumpdb_file, stream=stream, sharded=sharded)
+    ldumpdb_tsfile = c.rconfig.timestamped_backup_file('db', ext)
 
     # soft link appropriately
     ldumpdb_file = join(c.rconfig.lhome, dumpdb_relfile)
     if lexists(ldumpdb_file):
         remove(ldumpdb_file)
-    print('Getting {}'.format(dumpdb_relfile))
-    c.get(rdumpdb_file, ldumpdb_tsfile)
+    say(c, 'Getting {}'.format(dumpdb_relfile))
+    sha256 = parse_sha256sum(
+        c.run('sha256sum {}'.format(rdumpdb_file), hide=True).stdout)
+    stats = fetch(c.client.open_sftp, rdumpdb_file, ldumpdb_tsfile, sha256,
+                  streams=int(streams),
+                  progress=lambda done, total: say(
+                      c, 'fetch: {}/{}'.format(human_bytes(done),
+                                               human_bytes(total)),
+                      err=True))
+    say(c, '{status} {bytes} bytes ({resumed} resumed) in {seconds:.1f}s'
+        .format(**stats))
     symlink(ldumpdb_tsfile, ldumpdb_file)
     return ldumpdb_file
 
 
 @task
-def runcmd(c, script, args=''):
+def runcmd(c, script, args='', worker=None, jobs=None):
     '''
     Call managepy::runcmd with args as a comma-separated arg list
 
@@ -282,10 +404,25 @@ def runcmd(c, script, args=''):
 
     This runcmd takes same arguments but comma separated
     fab -H rsh runcmd scripts.needs_attention a1,a2,kw1=kwarg1,kw2=kwarg2
+
+    worker: run it in a warm djworker, see managepy
+    jobs: fan an items/run_item script out over this many processes
     '''
     autoconfig(c)
-    managepy(c, command='runcmd {} {}'.format(script,
-                                              ' '.join(args.split(','))))
+    options = ' --jobs {}'.format(jobs) if jobs else ''
+    managepy(c, command='runcmd {} {}{}'.format(script,
+                                                ' '.join(args.split(',')),
+                                                options),
+             worker=worker)
+
+
+@task
+def stopworker(c):
+    '''Stop the djworker started by managepy(worker=True), if any'''
+    autoconfig(c)
+    with c.cd(c.rconfig.managepydir):
+        c.run('{} dutils/djclient.py --stop'.format(c.rconfig.python),
+              warn=True)
 
 
 @task
@@ -320,11 +457,88 @@ def upgrade(c):
 
 
 @task
-def getdb(c, nomigs=False):
+def multi(c, taskname, hosts, workers=DEFAULT_WORKERS):
+    '''Run task taskname on several hosts concurrently
+
+    fab multi upgrade rs,rsph,rsdemo
+    Each host gets its own pooled connection, at most workers run at a time.
+    Command output is buffered and printed per host with a host prefix,
+    followed by a summary of time taken and success per host.
+    '''
+    func = globals()[taskname]
+
+    def run_on(host, out):
+        with pooled_connection(host, c.config.clone(), Connection) as conn:
+            conn.config.run.out_stream = out
+            conn.config.run.err_stream = out
+            return func(conn)
+
+    results = run_threads(hosts.split(','), run_on, workers=int(workers))
+    if not all(r.ok for r in results):
+        raise Exception('{} failed on {} host(s)'.format(
+            taskname, sum(not r.ok for r in results)))
+
+
+@task
+def getdb(c, nomigs=False, sharded=False, jobs=None, incremental=False,
+          pipelined=False, fast=False, filter_file=None, reuse=False):
+    '''getdbonly, dumpmedia, replacedb
+
+    pipelined: stream the dump from the server straight into the local
+    restore, with media synced at the same time. See getdbpipelined
+    fast, filter_file: see replacedb
+    reuse: see getdbonly'''
+    if pipelined:
+        return getdbpipelined(c, nomigs=nomigs, incremental=incremental,
+                              fast=fast, filter_file=filter_file)
     # getdbonly will do autoconfig
-    dbfile = getdbonly(c)
-    dumpmedia(c)
-    replacedb(c, dbfile, nomigs=nomigs)
+    dbfile = getdbonly(c, sharded=sharded, reuse=reuse)
+    dumpmedia(c, incremental=incremental)
+    replacedb(c, dbfile, nomigs=nomigs, jobs=jobs, fast=fast,
+              filter_file=filter_file)
+
+
+def _context_copy(c):
+    '''A new Context (or Connection, on its own ssh transport) like c'''
+    if hasattr(c, 'is_connected'):
+        return Connection(c.host, user=c.user, port=c.port,
+                          config=c.config.clone())
+    return c.__class__(config=c.config.clone())
+
+
+@task
+def getdbpipelined(c, nomigs=False, incremental=False, fast=False,
+                   filter_file=None):
+    '''Dump, download and load the db all at once, while syncing media
+
+    The server's mysqldump is compressed and sent over ssh straight into
+    replacedb, which loads it into the _tmp database as it arrives and
+    saves a copy to the timestamped backup file. Takes about as long as
+    the slowest of the three instead of their sum.'''
+    autoconfig(c)
+    ldumpdb_tsfile = c.rconfig.timestamped_backup_file('db', '.sql.gz')
+    dump_cmd = 'cd {dir} && {python} manage.py dumpdb --output=-'.format(
+        dir=c.rconfig.managepydir, python=c.rconfig.python)
+    source = "{ssh} {host} '{dump_cmd}'".format(
+        ssh=ssh_command(), host=c.host, dump_cmd=dump_cmd)
+
+    # c.cd() keeps its directory stack on the context, so the media
+    # thread must not share c
+    media_c = _context_copy(c)
+    try:
+        with ThreadPoolExecutor(1) as pool:
+            media = pool.submit(dumpmedia, media_c, incremental=incremental)
+            replacedb(c, '-', nomigs=nomigs, source=source,
+                      tee=ldumpdb_tsfile, fast=fast, filter_file=filter_file)
+            media.result()
+    finally:
+        if hasattr(media_c, 'is_connected'):
+            media_c.close()
+
+    ldumpdb_file = join(c.rconfig.lhome, c.rconfig.dumpdb_relfile)
+    if lexists(ldumpdb_file):
+        remove(ldumpdb_file)
+    symlink(ldumpdb_tsfile, ldumpdb_file)
 
 
 def forcelocal(c):
@@ -334,40 +548,13 @@ def forcelocal(c):
 
 
 @task
-def tags(c):
-    '''Re-build tags table for emacs'''
+def tags(c, incremental=False):
+    '''Re-build tags table for emacs
+
+    incremental: only re-parse files changed since the last run'''
     forcelocal(c)
-    with c.cd(c.lconfig.projdir):
-        c.run('find . -path "*migrations" -prune '
-              r'-o -name \*.html -print '
-              r'-o -name \*.py -print '
-              r'-o -name \*.js -print '
-              r'-o -name \*.sass -print '
-              '| etags -')
-        c.run('find . -path ./autoevals -prune -path "*migrations" -prune '
-              r'-o -name \*.html -print '
-              r'-o -name \*.py -print '
-              r'-o -name \*.js -print '
-              r'-o -name \*.sass -print '
-              '| etags -o TAGS_NOEVALS -')
-        c.run('find . -path "*migrations" -prune '
-              r'-o -name \*.py -print '
-              r'-o -name \*.sass -print '
-              '| etags -o TAGS_NOHTMLNOJS -')
-        c.run('find . -path ./autoevals -prune -path "*migrations" -prune '
-              r'-o -name \*.js -print '
-              r'-o -name \*.sass -print '
-              r'-o -name \*.html -print '
-              '| etags -o TAGS_ONLYJSHTML -')
-        c.run('find . -path ./autoevals -prune -path "*migrations" -prune '
-              r'-o -name \*.py -print '
-              r'-o -name \*.sass -print '
-              '| etags -o TAGS_ONLYPY -')
-        c.run('find . -path ./autoevals -prune -path "*migrations" -prune '
-              r'-o -name \*.py -print '
-              r'-o -name \*.html -print '
-              r'-o -name \*.sass -print '
-              '| etags -o TAGS_ONLYPYHTML -')
+    say(c, '{files} files, {parsed} parsed in {seconds:.1f}s'.format(
+        **build_tags(c.lconfig.projdir, incremental=incremental)))
 
 
 @task
@@ -411,10 +598,32 @@ def precompute_attention(c):
 
 
 @task
-def replacedb(c, dbfile=None, nomigs=False, verbose=False):
+def precompute_cache(c, model, method, workers=1, processes=False):
+    '''Fill model_cache field of model (app.Model) method in bulk'''
+    managepy(c, 'precompute_cache {} {} --workers {}{}'.format(
+        model, method, workers, ' --processes' if processes else ''))
+
+
+@task
+def replacedb(c, dbfile=None, nomigs=False, verbose=False, jobs=None,
+              source=None, tee=None, fast=False, filter_file=None,
+              warm=False):
     '''Replace db
 
     nomigs: don't run migrations
+    jobs: parallel table loaders for sharded dumps (default: all cores)
+    source: shell command whose output (a gzipped dump) is loaded,
+    with dbfile -
+    tee: with dbfile -, also save the dump to this file
+    fast: bulk-load session and server settings while loading (no
+    unique/FK checks, big transactions, no binlog), restored afterwards
+    filter_file: JSON table filter rules to leave out or cut down big
+    tables while loading, see tablefilter.py
+    warm: warm the buffer pool before swapping the new db in
+
+    Migrations run on <db>_tmp before it is swapped in, so the local db
+    stays usable until then. The previous db is kept as <db>_old, see
+    rollbackdb.
     '''
     autoconfig(c)
     dbfile = dbfile or c.rconfig.project
@@ -428,10 +637,35 @@ def replacedb(c, dbfile=None, nomigs=False, verbose=False):
         args += ' -n'
     if verbose:
         args += ' -d'
+    if jobs:
+        args += ' -j {}'.format(jobs)
+    if tee:
+        args += ' -t ' + tee
+    if fast:
+        args += ' -F'
+    if filter_file:
+        args += ' --filter-file ' + filter_file
+    if warm:
+        args += ' -w'
     args += ' -v'
     args += ' -- ' + dbfile
     cmd = '{python} {replacedb} {args}'.format(
         python=c.lconfig.python, replacedb=replacedb_path, args=args)
+    if source:
+        # pipefail: a failed dump must fail the task, not just the load
+        cmd = 'set -o pipefail; {} | {}'.format(source, cmd)
+
+    with c.cd(c.lconfig.projdir):
+        c.lconfig.lrun(cmd, echo=True)
 
+
+@task
+def rollbackdb(c):
+    '''Swap the db from before the last replacedb back in (and again)'''
+    autoconfig(c)
+    cmd = '{python} {replacedb} -p {path} -v --rollback'.format(
+        python=c.lconfig.python,
+        replacedb=join(dirname(__file__), 'replacedb.py'),
+        path=' '.join(c.lconfig.project_path))
     with c.cd(c.lconfig.projdir):
         c.lconfig.lrun(cmd, echo=True)
@@ -1,12 +1,97 @@
 from django import template
+from django.conf import settings
+from django.core.cache import caches
 from django.template.defaultfilters import stringfilter
 from django.utils.safestring import mark_safe
-from markdown.extensions.codehilite import CodeHiliteExtension
-from markdown import markdown
+from markdown import Markdown
+import hashlib
 import random
+import threading
+
+from dutils.lrucache import LRUCache
 
 register = template.Library()
 
+# Named markdown configurations (keyword arguments for markdown.Markdown).
+# More can be added with settings.DUTILS_MARKDOWN_CONFIGS, same format,
+# or with register_markdown_config, and used with the dmarkdownc filter.
+MARKDOWN_CONFIGS = {
+    'plain': {},
+    'codehilite': dict(
+        extensions=['codehilite'],
+        extension_configs={'codehilite': {'guess_lang': False}}),
+}
+MARKDOWN_CONFIGS.update(getattr(settings, 'DUTILS_MARKDOWN_CONFIGS', {}))
+
+# Markdown instances are not thread safe, so each thread builds its own,
+# once per config, and resets it after every use
+_renderers = threading.local()
+
+
+def register_markdown_config(name, **kwargs):
+    '''Add or replace a named config. Threads pick up the new one lazily'''
+    MARKDOWN_CONFIGS[name] = kwargs
+
+
+def render_markdown(content, config='plain'):
+    kwargs = MARKDOWN_CONFIGS[config]
+    by_config = getattr(_renderers, 'by_config', None)
+    if by_config is None:
+        by_config = _renderers.by_config = {}
+    md, built_from = by_config.get(config, (None, None))
+    if built_from is not kwargs:
+        md = Markdown(**kwargs)
+        by_config[config] = (md, kwargs)
+    try:
+        return md.convert(content)
+    finally:
+        md.reset()
+
+
+# Rendered markdown, keyed by config name and a hash of the content.
+# Settings:
+#   DUTILS_MARKDOWN_CACHE_SIZE: entries kept in process (0 disables)
+#   DUTILS_MARKDOWN_CACHE_TTL: seconds, None for no expiry
+#   DUTILS_MARKDOWN_CACHE_BACKEND: optional CACHES alias shared by processes
+_markdown_cache = LRUCache(
+    maxsize=getattr(settings, 'DUTILS_MARKDOWN_CACHE_SIZE', 2048),
+    ttl=getattr(settings, 'DUTILS_MARKDOWN_CACHE_TTL', None))
+_markdown_backend_stats = dict(hits=0, misses=0)
+
+
+def _config_key(config):
+    '''config name plus a digest of its extensions and their settings'''
+    return '{}-{}'.format(config, hashlib.sha1(
+        repr(sorted(MARKDOWN_CONFIGS[config].items())).encode('utf8'))
+        .hexdigest()[:8])
+
+
+def cached_markdown(content, config='plain'):
+    '''render_markdown(content, config), cached'''
+    if not _markdown_cache.maxsize:
+        return render_markdown(content, config)
+    key = 'dmarkdown:{}:{}'.format(
+        _config_key(config), hashlib.sha1(content.encode('utf8')).hexdigest())
+    html = _markdown_cache.get(key)
+    if html is not None:
+        return html
+    backend_alias = getattr(settings, 'DUTILS_MARKDOWN_CACHE_BACKEND', None)
+    backend = caches[backend_alias] if backend_alias else None
+    if backend is not None:
+        html = backend.get(key)
+        _markdown_backend_stats['hits' if html is not None else 'misses'] += 1
+    if html is None:
+        html = render_markdown(content, config)
+        if backend is not None:
+            backend.set(key, html, _markdown_cache.ttl)
+    _markdown_cache.set(key, html)
+    return html
+
+
+def markdown_cache_stats():
+    '''Hit/miss counters of the markdown cache, for profiling'''
+    return dict(_markdown_cache.stats(), backend=dict(_markdown_backend_stats))
+
 
 @register.filter
 @stringfilter
@@ -26,16 +111,21 @@ def django2bootstrap(tags):
 @stringfilter
 def dmarkdown(content):
     '''Markdown without codehilite'''
-    return mark_safe(markdown(content))
+    return mark_safe(cached_markdown(content, 'plain'))
 
 
 @register.filter
 @stringfilter
 def dmarkdownh(content):
     '''Markdown with codehilite'''
-    return mark_safe(markdown(
-        content,
-        extensions=[CodeHiliteExtension(guess_lang=False)]))
+    return mark_safe(cached_markdown(content, 'codehilite'))
+
+
+@register.filter
+@stringfilter
+def dmarkdownc(content, config):
+    '''Markdown with a named config: {{ text|dmarkdownc:"myconfig" }}'''
+    return mark_safe(cached_markdown(content, config))
 
 
 @register.filter
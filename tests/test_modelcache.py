@@ -0,0 +1,86 @@
+'''model_cache writes must reach rows that the default manager hides
+
+    python -m pytest tests/test_modelcache.py
+'''
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import django
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               # a file: precompute uses other threads
+                               'NAME': os.path.join(tempfile.mkdtemp(),
+                                                    'test.sqlite3')}},
+        INSTALLED_APPS=['django.contrib.contenttypes'],
+        CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    django.setup()
+
+from django.db import connection, models
+
+from modelcache import mark_stale, model_cache, precompute
+
+
+class LiveManager(models.Manager):
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted=False)
+
+
+class Company(models.Model):
+    deleted = models.BooleanField(default=False)
+    score_cache = models.IntegerField(null=True)
+
+    objects = LiveManager()
+
+    class Meta:
+        app_label = 'contenttypes'
+
+    @model_cache('score_cache')
+    def score(self):
+        return 42
+
+
+class FilteringDefaultManagerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with connection.schema_editor() as editor:
+            editor.create_model(Company)
+
+    @classmethod
+    def tearDownClass(cls):
+        with connection.schema_editor() as editor:
+            editor.delete_model(Company)
+
+    def setUp(self):
+        Company._base_manager.all().delete()
+        self.company = Company._base_manager.create(deleted=True)
+
+    def stored(self):
+        return Company._base_manager.get(pk=self.company.pk).score_cache
+
+    def test_write(self):
+        self.assertEqual(self.company.score(), 42)
+        self.assertEqual(self.stored(), 42)
+
+    def test_precompute(self):
+        done = precompute(Company._base_manager.all(), 'score',
+                          progress=None)
+        self.assertEqual(done, 1)
+        self.assertEqual(self.stored(), 42)
+
+    def test_mark_stale(self):
+        self.company.score()
+        mark_stale(Company._base_manager.all(), 'score')
+        self.assertIsNone(self.stored())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+'''Resumable, checksummed downloads of big files (db dumps) over SFTP
+
+    sha256 = parse_sha256sum(c.run('sha256sum ' + path, hide=True).stdout)
+    fetch(c.client.open_sftp, path, local_path, sha256)
+
+The file is fetched in CHUNK_SIZE byte ranges by several streams (SFTP
+channels on the same ssh connection) into local_path + '.part'. Finished
+chunks are recorded in local_path + '.part.json', so after a dropped
+connection the next fetch only gets the missing chunks, as long as the
+remote file still has the same checksum. The result is checked against
+the server's sha256 before it is renamed to local_path.
+
+If local_path already has that checksum nothing is downloaded.
+Nothing in here imports django or fabric.
+'''
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+from os.path import exists, getsize
+import sys
+import threading
+import time
+
+try:
+    from .dumputils import atomic_output, human_bytes
+except ImportError:
+    # run as a script
+    from dumputils import atomic_output, human_bytes
+
+CHUNK_SIZE = 32 << 20         # bytes per resumable range
+READ_SIZE = 1 << 20           # bytes per pipelined SFTP read
+STREAMS = 4
+HASH_BLOCKSIZE = 1 << 20
+
+
+class TransferError(Exception):
+    pass
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCKSIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def parse_sha256sum(output):
+    '''The digest from `sha256sum path` output'''
+    digest = output.strip().split()[0].lower()
+    if len(digest) != 64:
+        raise TransferError('Bad sha256sum output: {!r}'.format(output))
+    return digest
+
+
+def sftp_path(path):
+    '''SFTP does not expand ~, but starts in the home directory'''
+    return path[2:] if path.startswith('~/') else path
+
+
+class _PartialFile(object):
+    '''local_path.part plus the state file recording the finished chunks'''
+    def __init__(self, local_path, size, sha256, chunk_size):
+        self.path = local_path + '.part'
+        self.state_path = local_path + '.part.json'
+        self.state = dict(size=size, sha256=sha256, chunk_size=chunk_size,
+                          done=[])
+        self.lock = threading.Lock()
+        if exists(self.path) and exists(self.state_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if all(state.get(k) == self.state[k]
+                   for k in ('size', 'sha256', 'chunk_size')):
+                self.state = state
+        if not self.state['done']:
+            with open(self.path, 'wb') as f:
+                f.truncate(size)
+        self.fd = os.open(self.path, os.O_WRONLY)
+
+    def chunks(self):
+        '''[(index, offset, length)] still to be fetched'''
+        size, chunk_size = self.state['size'], self.state['chunk_size']
+        done = set(self.state['done'])
+        return [(i, offset, min(chunk_size, size - offset))
+                for i, offset in enumerate(range(0, size, chunk_size))
+                if i not in done]
+
+    def write(self, offset, data):
+        os.pwrite(self.fd, data, offset)
+
+    def finish_chunk(self, index):
+        os.fsync(self.fd)             # data first, then the record of it
+        with self.lock:
+            self.state['done'].append(index)
+            with atomic_output(self.state_path, 'w') as f:
+                json.dump(self.state, f)
+
+    def close(self):
+        os.close(self.fd)
+
+    def discard(self):
+        for path in (self.path, self.state_path):
+            if exists(path):
+                os.remove(path)
+
+
+def _print_progress(done, total):
+    sys.stderr.write('fetch: {}/{}\n'.format(human_bytes(done),
+                                             human_bytes(total)))
+
+
+def fetch(open_sftp, remote_path, local_path, sha256, streams=STREAMS,
+          chunk_size=CHUNK_SIZE, progress=_print_progress):
+    '''Download remote_path to local_path unless it is already there
+
+    open_sftp: callable returning a new paramiko SFTPClient; one is
+    opened per stream
+    sha256: the remote file's sha256, computed on the server
+    progress(done, total) is called after every chunk.
+    Returns a stats dict; status is 'skipped' or 'downloaded'.
+    '''
+    start = time.time()
+    remote_path = sftp_path(remote_path)
+    if exists(local_path) and file_sha256(local_path) == sha256:
+        return dict(status='skipped', bytes=0, resumed=0,
+                    seconds=time.time() - start)
+
+    sftp = open_sftp()
+    try:
+        size = sftp.stat(remote_path).st_size
+    finally:
+        sftp.close()
+
+    part = _PartialFile(local_path, size, sha256, chunk_size)
+    todo = part.chunks()
+    resumed = size - sum(length for i, offset, length in todo)
+    fetched = [resumed]
+    fetched_lock = threading.Lock()
+    local = threading.local()
+
+    def fetch_chunk(chunk):
+        index, offset, length = chunk
+        if not hasattr(local, 'file'):
+            local.sftp = open_sftp()
+            local.file = local.sftp.open(remote_path, 'rb')
+            clients.append(local.sftp)
+        ranges = [(o, min(READ_SIZE, offset + length - o))
+                  for o in range(offset, offset + length, READ_SIZE)]
+        # readv pipelines the reads instead of waiting on each one
+        for (o, n), data in zip(ranges, local.file.readv(ranges)):
+            if len(data) != n:
+                raise TransferError('Short read at {} of {}'.format(
+                    o, remote_path))
+            part.write(o, data)
+        part.finish_chunk(index)
+        with fetched_lock:
+            fetched[0] += length
+            if progress:
+                progress(fetched[0], size)
+
+    clients = []
+    try:
+        with ThreadPoolExecutor(max(1, min(streams, len(todo)))) as pool:
+            list(pool.map(fetch_chunk, todo))
+    finally:
+        part.close()
+        for client in clients:
+            client.close()
+
+    if file_sha256(part.path) != sha256:
+        part.discard()
+        raise TransferError('Checksum mismatch for {}, download discarded'
+                            .format(remote_path))
+    os.replace(part.path, local_path)
+    part.discard()
+    return dict(status='downloaded', bytes=getsize(local_path) - resumed,
+                resumed=resumed, seconds=time.time() - start)